@@ -0,0 +1,40 @@
+"""
+Time building ECS request URLs with ecs's XML operations.
+
+    python benchmarks/bench_ecs_requests.py --requests 50000
+
+query() is replaced by one that returns the URL it is given, so only
+binding the arguments and encoding the request is timed. --module uses
+another version of ecs.py, e.g. the inspect-based one from before the
+operations were generated from a table:
+
+    git show 278846c:booklistapp/ecs.py > /tmp/ecs_old.py
+    python benchmarks/bench_ecs_requests.py --module /tmp/ecs_old.py
+"""
+import time
+from optparse import OptionParser
+import common
+import fixtures
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--requests', type='int', default=50000,
+                      help="Requests to build.")
+    parser.add_option('--module', help="ecs.py to use instead of the current one.")
+    options, args = parser.parse_args()
+    ecs = common.load('ecs', options.module)
+    ecs.LICENSE_KEY = 'key'
+    ecs.query = lambda url: url
+    calls = [(getattr(ecs, 'XML' + operation), kwargs)
+             for operation, kwargs in fixtures.ecs_requests(options.requests)]
+    started = time.time()
+    for operation, kwargs in calls:
+        operation(**kwargs)
+    elapsed = time.time() - started
+    print "%d requests built in %.2fs, %.1f us each" % (
+        len(calls), elapsed, elapsed / max(len(calls), 1) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
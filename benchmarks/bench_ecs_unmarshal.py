@@ -0,0 +1,56 @@
+"""
+Time unmarshalling a large ECS ItemLookup response with ecs, and
+report the peak memory it took.
+
+    python benchmarks/bench_ecs_unmarshal.py --items 20000
+
+The response goes through ecs.rawIterator, as ItemLookup's pages do,
+with query() answering from the fixture instead of Amazon. Run it once
+per implementation, each in its own process so the peak memory figures
+are separate; --module uses another version of ecs.py, e.g. the
+minidom one from before the streaming unmarshal:
+
+    git show 278846c:booklistapp/ecs.py > /tmp/ecs_old.py
+    python benchmarks/bench_ecs_unmarshal.py --module /tmp/ecs_old.py
+"""
+import os
+import time
+from optparse import OptionParser
+from xml.dom import minidom
+import common
+import fixtures
+
+# As ItemLookup unmarshals its results.
+ITEM_PLUGINS = {'isPivoted': lambda x: x == 'ItemAttributes',
+                'isCollective': lambda x: x == 'Items',
+                'isCollected': lambda x: x == 'Item'}
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--items', type='int', default=20000,
+                      help="Items in the synthetic response.")
+    parser.add_option('--fixture',
+                      help="Response file to use, made first if it doesn't exist.")
+    parser.add_option('--module', help="ecs.py to use instead of the current one.")
+    options, args = parser.parse_args()
+    path = common.fixture(fixtures.ecs_item_lookup, options.items, options.fixture)
+    ecs = common.load('ecs', options.module)
+    data = open(path).read()
+    if not options.fixture:
+        os.unlink(path)
+    started = time.time()
+    # Stand in for query(), returning what each version of it would.
+    if hasattr(ecs, 'XMLResponse'):
+        ecs.query = lambda url: ecs.XMLResponse(data)
+    else:
+        ecs.query = lambda url: minidom.parseString(data)
+    items = ecs.rawIterator(ecs.XMLItemLookup, {'ItemId': '0', 'AWSAccessKeyId': 'key'},
+                            'Items', ITEM_PLUGINS)
+    elapsed = time.time() - started
+    print "%d items unmarshalled in %.2fs, %.1f us each; peak RSS %.0fMB" % (
+        len(items), elapsed, elapsed / max(len(items), 1) * 1e6, common.peak_rss())
+
+
+if __name__ == '__main__':
+    main()
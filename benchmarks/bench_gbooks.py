@@ -0,0 +1,50 @@
+"""
+Time parsing a large Google Books feed with gbooks, and report the
+peak memory it took.
+
+    python benchmarks/bench_gbooks.py --entries 50000
+
+Run it once per implementation, each in its own process so the peak
+memory figures are separate; --module parses with another version of
+gbooks.py, e.g. the tree-building one from before the streaming parser:
+
+    git show 278846c:booklistapp/gbooks.py > /tmp/gbooks_old.py
+    python benchmarks/bench_gbooks.py --module /tmp/gbooks_old.py > /dev/null
+
+(That version imports the separate elementtree package; to compare
+like with like, make it import xml.etree.cElementTree instead. It also
+prints every link, hence the redirect; the timing goes to stderr.)
+"""
+import os
+import sys
+import time
+from optparse import OptionParser
+import common
+import fixtures
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--entries', type='int', default=50000,
+                      help="Entries in the synthetic feed.")
+    parser.add_option('--fixture',
+                      help="Feed file to use, made first if it doesn't exist.")
+    parser.add_option('--module', help="gbooks.py to use instead of the current one.")
+    options, args = parser.parse_args()
+    path = common.fixture(fixtures.gbooks_feed, options.entries, options.fixture)
+    gbooks = common.load('gbooks', options.module)
+    started = time.time()
+    f = open(path)
+    try:
+        books = gbooks._parse_url(f)
+    finally:
+        f.close()
+    elapsed = time.time() - started
+    if not options.fixture:
+        os.unlink(path)
+    print >>sys.stderr, "%d books parsed in %.2fs, %.1f us each; peak RSS %.0fMB" % (
+        len(books), elapsed, elapsed / max(len(books), 1) * 1e6, common.peak_rss())
+
+
+if __name__ == '__main__':
+    main()
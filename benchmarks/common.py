@@ -0,0 +1,44 @@
+"""Helpers shared by the benchmark scripts."""
+import imp
+import os
+import resource
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The app's modules import each other, and the shared top-level ones,
+# by bare name.
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'booklistapp')]
+
+
+def load(name, path=None):
+    """
+    Import booklistapp's module name, or the file at path in its
+    place, e.g. an older version saved with
+    git show <rev>:booklistapp/<name>.py > /tmp/<name>_old.py
+    """
+    if path:
+        return imp.load_source(name, path)
+    return __import__(name)
+
+
+def fixture(generate, count, path=None):
+    """
+    Return the path of a fixture made by generate(out, count), written
+    to path, or to a temporary file, unless path already exists.
+    """
+    if path and os.path.exists(path):
+        return path
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        os.close(fd)
+    with open(path, 'w') as out:
+        generate(out, count)
+    return path
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on Mac OS X.
+    return peak / (sys.platform == 'darwin' and 2.0**20 or 2.0**10)
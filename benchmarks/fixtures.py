@@ -0,0 +1,96 @@
+"""
+Synthetic responses for the benchmarks, written a record at a time so
+that making a large one takes next to no memory.
+
+    python benchmarks/fixtures.py gbooks 50000 > feed.xml
+    python benchmarks/fixtures.py ecs 20000 > items.xml
+"""
+import sys
+
+
+def gbooks_feed(out, entries):
+    """Write a Google Books volumes feed of `entries` entries to out."""
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<feed xmlns="http://www.w3.org/2005/Atom" '
+              'xmlns:dc="http://purl.org/dc/terms" '
+              'xmlns:gbs="http://schemas.google.com/books/2008">\n'
+              '<title>Search results</title>\n')
+    for n in range(entries):
+        gid = 'gid%08d' % n
+        out.write(
+            '<entry>\n'
+            '<id>http://www.google.com/books/feeds/volumes/%(gid)s</id>\n'
+            '<title type="text">Book number %(n)d</title>\n'
+            '<link rel="http://schemas.google.com/books/2008/thumbnail" type="image/x-unknown" '
+            'href="http://bks0.books.google.com/books?id=%(gid)s&amp;printsec=frontcover&amp;img=1&amp;zoom=5"/>\n'
+            '<link rel="http://schemas.google.com/books/2008/info" type="text/html" '
+            'href="http://books.google.com/books?id=%(gid)s&amp;ie=ISO-8859-1"/>\n'
+            '<link rel="http://schemas.google.com/books/2008/preview" type="text/html" '
+            'href="http://books.google.com/books?id=%(gid)s&amp;printsec=frontcover"/>\n'
+            '<link rel="alternate" type="text/html" href="http://books.google.com/books?id=%(gid)s"/>\n'
+            '<link rel="self" type="application/atom+xml" '
+            'href="http://www.google.com/books/feeds/volumes/%(gid)s"/>\n'
+            '<dc:creator>First Author %(n)d</dc:creator>\n'
+            '<dc:creator>Second Author</dc:creator>\n'
+            '<dc:date>2009</dc:date>\n'
+            '<dc:format>350 pages</dc:format>\n'
+            '<dc:identifier>%(gid)s</dc:identifier>\n'
+            '<dc:identifier>ISBN:%(isbn10)s</dc:identifier>\n'
+            '<dc:identifier>ISBN:%(isbn13)s</dc:identifier>\n'
+            '<dc:publisher>Publisher</dc:publisher>\n'
+            '<dc:subject>Computers</dc:subject>\n'
+            '<dc:title>Book number %(n)d</dc:title>\n'
+            '</entry>\n' % {'gid': gid, 'n': n, 'isbn10': '%010d' % n,
+                            'isbn13': '978%010d' % n})
+    out.write('</feed>\n')
+
+
+def ecs_item_lookup(out, items):
+    """Write an ECS ItemLookup response of `items` items to out."""
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<ItemLookupResponse xmlns="http://webservices.amazon.com/AWSECommerceService/2007-02-22">\n'
+              '<OperationRequest><RequestId>0</RequestId>'
+              '<Arguments><Argument Name="Service" Value="AWSECommerceService"/></Arguments>'
+              '<RequestProcessingTime>0.01</RequestProcessingTime></OperationRequest>\n'
+              '<Items><Request><IsValid>True</IsValid>'
+              '<ItemLookupRequest><ItemId>0</ItemId></ItemLookupRequest></Request>\n')
+    for n in range(items):
+        out.write(
+            '<Item><ASIN>B%09d</ASIN>'
+            '<DetailPageURL>http://www.amazon.com/dp/B%09d</DetailPageURL>'
+            '<ItemAttributes>'
+            '<Author>First Author %d</Author><Author>Second Author</Author>'
+            '<Binding>Paperback</Binding><EAN>978%010d</EAN><ISBN>%010d</ISBN>'
+            '<Manufacturer>Publisher</Manufacturer><NumberOfPages>350</NumberOfPages>'
+            '<ProductGroup>Book</ProductGroup><Title>Book number %d</Title>'
+            '</ItemAttributes>'
+            '<SmallImage><URL>http://ecx.images-amazon.com/images/I/%d.jpg</URL>'
+            '<Height Units="pixels">75</Height><Width Units="pixels">50</Width></SmallImage>'
+            '</Item>\n' % (n, n, n, n, n, n, n))
+    out.write('</Items>\n</ItemLookupResponse>\n')
+
+
+def ecs_requests(count):
+    """
+    Yield (operation, kwargs) for count ECS requests, cycling through
+    lookups and searches with values that do and don't need quoting.
+    """
+    for n in range(count):
+        kind = n % 3
+        if kind == 0:
+            yield 'ItemLookup', {'ItemId': '%010d' % n, 'ResponseGroup': 'Medium'}
+        elif kind == 1:
+            yield 'ItemLookup', {'ItemId': '978%010d' % n, 'IdType': 'ISBN',
+                                 'SearchIndex': 'Books', 'ResponseGroup': 'Large,Offers'}
+        else:
+            yield 'ItemSearch', {'Keywords': 'human computer interaction %d' % n,
+                                 'SearchIndex': 'Books', 'ItemPage': n % 10 + 1}
+
+
+GENERATORS = {'gbooks': gbooks_feed, 'ecs': ecs_item_lookup}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in GENERATORS:
+        sys.exit("usage: %s gbooks|ecs <count>" % sys.argv[0])
+    GENERATORS[sys.argv[1]](sys.stdout, int(sys.argv[2]))
@@ -1,9 +1,23 @@
 from models import *
 from django.contrib import admin
 
+
+class CategoryAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        obj.save()
+        # The books are saved by save_m2m() after this, and sending no
+        # signal, so bump the catalogue version once they are.
+        save_m2m = form.save_m2m
+        def save_m2m_and_bump():
+            save_m2m()
+            CatalogueVersion.bump()
+        form.save_m2m = save_m2m_and_bump
+
+
 admin.site.register(Book)
-admin.site.register(Category)
+admin.site.register(Category, CategoryAdmin)
 admin.site.register(CategoryType)
 #admin.site.register(User)
 admin.site.register(Recommendation)
-admin.site.register(FeedbackNote)
\ No newline at end of file
+admin.site.register(FeedbackNote)
+admin.site.register(CoverFetch)
\ No newline at end of file
@@ -0,0 +1,190 @@
+"""
+An in-memory bitmap index of category membership, for filtering the
+book list by several categories at once.
+
+Books are numbered by their position in the list, newest edit first,
+and each category is a bitset (a Python long) with bit n set if the
+nth book is in it. A filter such as ?c=programming+undergrads ORs the
+bitsets of the chosen categories within each CategoryType and ANDs
+the results across types, so "programming or design, for undergrads"
+is a few big-integer operations instead of a join per category, and
+its pages come straight off the set bits in list order.
+
+    index = categoryindex.get_index(CatalogueVersion.current().counter)
+    page = index.page(index.filter(['programming', 'undergrads']))
+
+The index is per process and is rebuilt, from two queries, the first
+time it is asked for after the catalogue version changes; see
+book_changed() for the one change that is applied in place.
+"""
+import binascii
+import threading
+from bisect import bisect_left, bisect_right
+from django.db import connection
+from models import Book, Category
+from pagination import PER_PAGE, decode_cursor, encode_cursor
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_index(counter):
+    """Return the index as of catalogue version counter."""
+    global _index
+    with _lock:
+        if _index is None or _index.counter != counter:
+            _index = CategoryIndex(counter)
+        return _index
+
+
+def book_changed(book_id, category_ids, before, after, bumps=1):
+    """
+    Record that the Book with book_id is now in exactly the categories
+    with category_ids, a change which took the catalogue from version
+    before to version after in `bumps` steps, none of which changed
+    any other membership or the order of the books. If that was the
+    only change since this process's index was built, the index is
+    updated in place, rather than rebuilt by the next request.
+    """
+    with _lock:
+        if _index is not None and _index.counter == before and after == before + bumps:
+            _index.set_categories(book_id, category_ids)
+            _index.counter = after
+
+
+class CategoryIndex(object):
+
+    def __init__(self, counter):
+        self.counter = counter
+        # Built oldest first, so the keys ascend for bisect.
+        rows = list(Book.objects.order_by('edited', 'id').values_list('edited', 'id'))
+        self.size = len(rows)
+        self._keys = rows
+        self._ids = [id for edited, id in reversed(rows)]
+        self._positions = dict((id, n) for n, id in enumerate(self._ids))
+        self.all = (1 << self.size) - 1
+        self._categories = {}   # slug -> (id, category type id, name)
+        positions = {}          # category id -> [position, ...]
+        for id, slug, type_id, name in Category.objects.values_list(
+                'id', 'slug', 'category_type', 'name'):
+            self._categories[slug] = (id, type_id, name)
+            positions[id] = []
+        for book_id, category_id in _memberships():
+            if book_id in self._positions:
+                positions[category_id].append(self._positions[book_id])
+        self._bits = dict((id, _bitset(p, self.size)) for id, p in positions.items())
+
+    def names(self, slugs):
+        """Return the names of the categories with slugs."""
+        return [self._categories[slug][2] for slug in slugs]
+
+    def filter(self, slugs):
+        """
+        Return the bitset of books in any of the categories with slugs
+        of each CategoryType given. Raises KeyError for an unknown slug.
+        """
+        by_type = {}
+        for slug in slugs:
+            id, type_id, name = self._categories[slug]
+            by_type[type_id] = by_type.get(type_id, 0) | self._bits[id]
+        bits = self.all
+        for union in by_type.values():
+            bits &= union
+        return bits
+
+    def count(self, bits):
+        return bin(bits).count('1')
+
+    def set_categories(self, book_id, category_ids):
+        """Put the Book with book_id in exactly the categories with category_ids."""
+        n = self._positions.get(book_id)
+        if n is None:
+            return
+        for id, bits in self._bits.items():
+            if id in category_ids:
+                self._bits[id] = bits | (1 << n)
+            else:
+                self._bits[id] = bits & ~(1 << n)
+
+    def page(self, bits, after=None, before=None, per_page=PER_PAGE):
+        """
+        Return the BitmapPage of bits from the cursor after or before,
+        as pagination.CursorPage would. Raises ValueError for a
+        malformed cursor.
+        """
+        if before:
+            # Only the books newer than before.
+            end = self.size - bisect_right(self._keys, decode_cursor(before))
+            found = _highest(bits & ((1 << end) - 1), per_page + 1)
+            if len(found) > per_page:
+                return BitmapPage(self._books(found[per_page - 1::-1]), True, True)
+            after = None
+        start = 0
+        if after:
+            start = self.size - bisect_left(self._keys, decode_cursor(after))
+        found = _lowest(bits >> start, per_page + 1)
+        return BitmapPage(self._books([start + n for n in found[:per_page]]),
+                          len(found) > per_page, bool(after))
+
+    def _books(self, positions):
+        """Return the Books at positions, in that order, from one query."""
+        ids = [self._ids[n] for n in positions]
+        books = Book.objects.in_bulk(ids)
+        return [books[id] for id in ids if id in books]
+
+
+class BitmapPage(object):
+    """A page of books found by CategoryIndex.page(); like a CursorPage."""
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def next_cursor(self):
+        if self.has_next:
+            return encode_cursor(self.object_list[-1])
+
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return encode_cursor(self.object_list[0])
+
+
+def _memberships():
+    """Return every (book id, category id) pair, in one query."""
+    field = Category._meta.get_field('books')
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s, %s FROM %s' % (
+                       qn(field.m2m_reverse_name()), qn(field.m2m_column_name()),
+                       qn(field.m2m_db_table())))
+    return cursor.fetchall()
+
+
+def _bitset(positions, size):
+    """Return a long with the bits at positions set, in time linear in size."""
+    buf = bytearray(size // 8 + 1)
+    for n in positions:
+        buf[n >> 3] |= 1 << (n & 7)
+    buf.reverse()
+    return int(binascii.hexlify(buf), 16)
+
+
+def _lowest(bits, limit):
+    """Return the positions of up to limit of the lowest set bits, ascending."""
+    found = []
+    while bits and len(found) < limit:
+        low = bits & -bits
+        found.append(low.bit_length() - 1)
+        bits ^= low
+    return found
+
+
+def _highest(bits, limit):
+    """Return the positions of up to limit of the highest set bits, descending."""
+    found = []
+    while bits and len(found) < limit:
+        n = bits.bit_length() - 1
+        found.append(n)
+        bits ^= 1 << n
+    return found
@@ -0,0 +1,165 @@
+"""
+Cover image downloading.
+
+Adding a book only queues its cover (enqueue()); the fetch_covers
+management command downloads queued covers in the background with
+a bounded number of threads, a timeout per download, and retries
+with exponential backoff. Books render a placeholder until their
+cover arrives.
+
+Covers are stored content-addressed: a cover's file name is the SHA-1
+of its bytes, sharded into two levels of subdirectories (see
+cover_path()), so identical covers share one file. Book.cover_image
+holds the path relative to COVER_DIR, and the number of Books naming
+a path is its reference count. release() deletes a file once nothing
+refers to it, and the gc_covers management command sweeps up any
+files that slipped through.
+"""
+import datetime
+import errno
+import hashlib
+import os
+import random
+import tempfile
+import urllib2
+from settings import COVER_DIR, COVER_FETCH_TIMEOUT, \
+                     COVER_FETCH_CONCURRENCY, COVER_FETCH_MAX_ATTEMPTS
+from models import Book, CatalogueVersion, CoverFetch
+from utils import parallel_map
+
+# Retry delays grow as BACKOFF_BASE * 2**attempts seconds, up to BACKOFF_MAX.
+BACKOFF_BASE = 30
+BACKOFF_MAX = 6 * 60 * 60
+
+
+def enqueue(book, url):
+    """Queue a download of url as the cover of book, replacing any old job."""
+    try:
+        job = CoverFetch.objects.get(book=book)
+    except CoverFetch.DoesNotExist:
+        job = CoverFetch(book=book)
+    job.url = url
+    job.attempts = 0
+    job.next_attempt = datetime.datetime.now()
+    job.failed = False
+    job.last_error = ''
+    job.save()
+    return job
+
+
+def download(url, timeout=COVER_FETCH_TIMEOUT):
+    """Return the bytes at url, raising on any error or timeout."""
+    req = urllib2.Request(url)
+    req.add_header("User-Agent", "Mozilla")
+    image_link = urllib2.urlopen(req, timeout=timeout)
+    try:
+        return image_link.read()
+    finally:
+        image_link.close()
+
+
+def cover_path(digest):
+    """Return the path, relative to COVER_DIR, of the cover with this hash."""
+    return os.path.join(digest[:2], digest[2:4], digest)
+
+
+def store(img_data):
+    """
+    Write cover bytes into COVER_DIR, unless a cover with the same
+    bytes is already there (which is touched instead), and return the
+    path to use for Book.cover_image.
+    """
+    name = cover_path(hashlib.sha1(img_data).hexdigest())
+    dest = os.path.join(COVER_DIR, name)
+    if os.path.exists(dest):
+        # Touch it, so gc_covers --min-age leaves it alone until the
+        # Book about to be linked to it has been saved.
+        try:
+            os.utime(dest, None)
+            return name
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+    shard = os.path.dirname(dest)
+    try:
+        os.makedirs(shard)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Write under a temporary name first so nobody ever sees a
+    # partial cover; rename() is atomic within a filesystem.
+    fd, tmp = tempfile.mkstemp(dir=shard, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(img_data)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, dest)
+    except:
+        os.unlink(tmp)
+        raise
+    return name
+
+
+def release(name):
+    """
+    Delete the cover stored at name if no Book refers to it any more.
+    Call after deleting or re-covering a Book.
+    """
+    if not name or Book.objects.filter(cover_image=name).count():
+        return False
+    try:
+        os.unlink(os.path.join(COVER_DIR, name))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def backoff(attempts):
+    """Seconds to wait before the next try after `attempts` failures."""
+    delay = min(BACKOFF_BASE * 2 ** attempts, BACKOFF_MAX)
+    # Jitter, so covers that failed together don't retry together.
+    return delay * random.uniform(0.5, 1.0)
+
+
+def run_once(batch_size=50, concurrency=COVER_FETCH_CONCURRENCY,
+             timeout=COVER_FETCH_TIMEOUT, max_attempts=COVER_FETCH_MAX_ATTEMPTS):
+    """
+    Download up to batch_size covers that are due, using at most
+    `concurrency` threads. Only the downloads run in threads; the
+    database is touched from the calling thread. Returns a
+    (fetched, failed) pair of counts.
+    """
+    now = datetime.datetime.now()
+    jobs = list(CoverFetch.objects.filter(failed=False, next_attempt__lte=now)
+                                  .order_by('next_attempt')[:batch_size])
+    results = parallel_map(lambda job: download(job.url, timeout),
+                           jobs, concurrency)
+    fetched = failed = 0
+    for job, (img_data, error) in zip(jobs, results):
+        if error is None:
+            try:
+                fn = store(img_data)
+            except (IOError, OSError), e:
+                error = e
+            else:
+                # update() rather than save(), so a new cover doesn't
+                # count as an edit and reorder the list.
+                Book.objects.filter(pk=job.book_id).update(cover_image=fn)
+                job.delete()
+                fetched += 1
+                continue
+        failed += 1
+        job.attempts += 1
+        job.last_error = repr(error)
+        if job.attempts >= max_attempts:
+            job.failed = True
+        else:
+            job.next_attempt = datetime.datetime.now() + \
+                datetime.timedelta(seconds=backoff(job.attempts))
+        job.save()
+    if fetched:
+        # The covers were set with update(), which sends no signals.
+        CatalogueVersion.bump()
+    return fetched, failed
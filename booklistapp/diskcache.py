@@ -0,0 +1,144 @@
+"""
+A size-capped, persistent key/value cache in an SQLite file.
+
+Values are byte strings, stored zlib-compressed with an expiry time.
+When the stored total passes max_size, the least recently used
+entries are evicted. Several processes (and threads) can share one
+file: SQLite does the locking, and WAL journalling lets readers carry
+on while one of them writes.
+
+    cache = DiskCache('/var/cache/thing.sqlite', max_size=50 * 2**20)
+    cache.set('key', data, ttl=3600)
+    data = cache.get('key')     # None once expired or evicted
+
+It's only a cache, so a database error on a read counts as a miss and
+one on a write is dropped; neither reaches the caller.
+"""
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# Last-use times are only rewritten when older than this, so that
+# most reads don't have to take the write lock.
+TOUCH_INTERVAL = 60
+# Check the total size after this many writes.
+EVICT_INTERVAL = 32
+# Evict down to this fraction of max_size, to make room for a while.
+EVICT_TO = 0.9
+
+
+class DiskCache(object):
+
+    def __init__(self, path, max_size=50 * 2**20, timeout=30):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _db(self):
+        """
+        Return this thread's connection to the cache file, creating
+        the file on first use.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    pass    # connect() will fail with an sqlite3.Error
+            # Autocommit; each statement is its own transaction.
+            db = sqlite3.connect(self.path, timeout=self.timeout,
+                                 isolation_level=None)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                       ' key TEXT PRIMARY KEY, value BLOB, size INTEGER,'
+                       ' expires REAL, used REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+            self._local.db = db
+        return db
+
+    def get(self, key, default=None):
+        """Return the value stored under key, or default."""
+        now = time.time()
+        try:
+            db = self._db()
+            row = db.execute('SELECT value, expires, used FROM cache WHERE key = ?',
+                             (key,)).fetchone()
+            if row is None or row[1] <= now:
+                self.misses += 1
+                return default
+            if now - row[2] > TOUCH_INTERVAL:
+                db.execute('UPDATE cache SET used = ? WHERE key = ?', (now, key))
+            value = zlib.decompress(row[0])
+        except (sqlite3.Error, zlib.error):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        """Store value under key for ttl seconds."""
+        now = time.time()
+        data = sqlite3.Binary(zlib.compress(value))
+        try:
+            self._db().execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                               (key, data, len(data), now + ttl, now))
+        except sqlite3.Error:
+            return
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % EVICT_INTERVAL == 1
+        if evict:
+            self.evict()
+
+    def delete(self, key):
+        try:
+            self._db().execute('DELETE FROM cache WHERE key = ?', (key,))
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        try:
+            self._db().execute('DELETE FROM cache')
+        except sqlite3.Error:
+            pass
+
+    def size(self):
+        """Return the total stored (compressed) size in bytes."""
+        try:
+            return self._db().execute('SELECT total(size) FROM cache').fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    def evict(self):
+        """
+        Drop expired entries, then if the cache is still over
+        max_size, the least recently used ones.
+        """
+        try:
+            db = self._db()
+            db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+            total = self.size()
+            if total <= self.max_size:
+                return
+            excess = total - self.max_size * EVICT_TO
+            doomed = []
+            rows = db.execute('SELECT key, size FROM cache ORDER BY used')
+            for key, size in rows:
+                doomed.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            rows.close()
+            db.executemany('DELETE FROM cache WHERE key = ?', doomed)
+        except sqlite3.Error:
+            pass
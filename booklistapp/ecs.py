@@ -18,8 +18,16 @@ License: Python Software Foundation License
 """
 
 
-import os, urllib, string, inspect
+import os, re, cgi, urllib, urlparse, string, threading
+import httpclient
+import ratelimit
+from utils import LRUCache, parallel_map
+from StringIO import StringIO
 from xml.dom import minidom
+try:
+	from xml.etree import cElementTree as ElementTree
+except ImportError:
+	from elementtree import ElementTree
 
 __author__ = "Kun Xi < kunxi@kunxi.org >"
 __version__ = "0.2.0"
@@ -32,6 +40,27 @@ LICENSE_KEY = None;
 HTTP_PROXY = None
 LOCALE = "us"
 VERSION = "2007-02-22"
+CACHE = None
+# At most one request a second per license key, Amazon's limit
+RATE_LIMITER = ratelimit.RateLimiter(1)
+
+# How long query() may keep responses to each operation, in seconds,
+# when a cache is set (see setCache). Operations not listed, which
+# includes the Cart ones, are never cached.
+CACHE_TTLS = {
+		"ItemLookup" : 24 * 60 * 60,
+		"SimilarityLookup" : 24 * 60 * 60,
+		"BrowseNodeLookup" : 24 * 60 * 60,
+		"Help" : 7 * 24 * 60 * 60,
+		"ItemSearch" : 60 * 60,
+		"ListLookup" : 60 * 60,
+		"ListSearch" : 60 * 60,
+		"CustomerContentLookup" : 60 * 60,
+		"CustomerContentSearch" : 60 * 60,
+		"SellerLookup" : 60 * 60,
+		"SellerListingLookup" : 15 * 60,
+		"SellerListingSearch" : 15 * 60
+	}
 
 __supportedLocales = {
 		None : "webservices.amazon.com",  
@@ -80,6 +109,7 @@ class MissingParameterValueCombination(AWSException): pass
 class MissingServiceParameter(AWSException): pass
 class ParameterOutOfRange(AWSException): pass
 class ParameterRepeatedInRequest(AWSException): pass
+class RequestThrottled(AWSException): pass
 class RestrictedParameterValueCombination(AWSException): pass
 class XSLTTransformationError(AWSException): pass
 
@@ -107,6 +137,35 @@ def getLocale():
 	return LOCALE
 
 
+def setCache(cache):
+	"""set the response cache
+
+	cache is anything with get(key) and set(key, value, ttl) methods,
+	such as a diskcache.DiskCache, which several processes can share.
+	None turns caching off."""
+	global CACHE
+	CACHE = cache
+
+
+def getCache():
+	"""get the response cache"""
+	return CACHE
+
+
+def setRateLimiter(limiter):
+	"""set the rate limiter
+
+	limiter is a ratelimit.RateLimiter; requests are limited per host
+	and license key. None turns rate limiting off."""
+	global RATE_LIMITER
+	RATE_LIMITER = limiter
+
+
+def getRateLimiter():
+	"""get the rate limiter"""
+	return RATE_LIMITER
+
+
 def setLicenseKey(license_key=None):
 	"""set license key
 
@@ -144,50 +203,124 @@ def buildRequest(argv):
 	all key, value pairs in argv are quoted."""
 
 	url = "http://" + __supportedLocales[getLocale()] + "/onca/xml?Service=AWSECommerceService&"
-	return url + '&'.join(['%s=%s' % (k,urllib.quote(str(v))) for (k,v) in argv.items() if v]) 
+	return url + __encode(argv)
 
 
-def buildException(els):
-	"""Build the exception from the returned DOM node
+def buildException(error):
+	"""Build the exception from the returned Error element
 
 	Only the first exception is raised."""
 
-	error = els[0]
-	class_name = error.childNodes[0].firstChild.data[4:]
-	msg = error.childNodes[1].firstChild.data 
+	# Codes look like AWS.InvalidParameterValue, or RequestThrottled
+	code = error.findtext('Code') or ''
+	class_name = code.split('.')[-1]
+	msg = error.findtext('Message')
 
-	e = globals()[ class_name ](msg)
+	e = globals().get(class_name, AWSException)(msg)
 	return e
 
 
-def query(url):
-	"""Send the query url and return the DOM
-	
-	Exception is raised if there is errors"""
-	u = urllib.FancyURLopener(HTTP_PROXY)
-	usock = u.open(url)
-	dom = minidom.parse(usock)
-	usock.close()
+class XMLResponse(object):
+	"""The raw XML of a response.
+
+	The unmarshalled interfaces stream it through unmarshal(); for the
+	XMLfoo interfaces it behaves as the DOM object, parsing it with
+	minidom on first use."""
+
+	def __init__(self, data):
+		self.data = data
+		self.__dom = None
+
+	def __getattr__(self, name):
+		if name.startswith('__'):
+			raise AttributeError(name)
+		if self.__dom is None:
+			self.__dom = minidom.parseString(self.data)
+		return getattr(self.__dom, name)
+
 
-	errors = dom.getElementsByTagName('Error')
-	if errors:
-		e = buildException(errors)
-		raise e
-	return dom
+def cacheKey(url):
+	"""Return the (key, ttl) to cache the response to url under
+
+	The key is the request with its parameters sorted and the license
+	key left out, so the same request from any caller finds the same
+	entry. ttl is None for operations that mustn't be cached."""
+
+	scheme, host, path, args, fragment = urlparse.urlsplit(url)
+	args = [(k, v) for (k, v) in cgi.parse_qsl(args) if k != 'AWSAccessKeyId']
+	ttl = CACHE_TTLS.get(dict(args).get('Operation'))
+	args.sort()
+	return host + path + '?' + urllib.urlencode(args), ttl
+
+
+def isTransient(error):
+	"""Whether the request that raised error is worth retrying"""
+	if isinstance(error, httpclient.HTTPError):
+		return error.status >= 500
+	return isinstance(error, (RequestThrottled, InternalError))
+
+
+__accountPattern = re.compile(r'[?&]AWSAccessKeyId=([^&]*)')
+
+def query(url):
+	"""Send the query url and return the XMLResponse
+
+	If a cache is set, the response is looked for there first, and
+	saved there after. Requests go through the rate limiter, which
+	retries them on throttling and server errors. Exception is raised
+	if there is errors"""
+	cache = CACHE
+	if cache is not None:
+		key, ttl = cacheKey(url)
+		if ttl:
+			data = cache.get(key)
+			if data is not None:
+				return XMLResponse(data)
+
+	def fetch():
+		if HTTP_PROXY:
+			usock = urllib.FancyURLopener(HTTP_PROXY).open(url)
+		else:
+			# Keep-alive connection shared with the rest of the app
+			usock = httpclient.request('GET', url)
+		data = usock.read()
+		usock.close()
+
+		# Only parse for errors when there can be some
+		if '<Error>' in data:
+			for event, element in ElementTree.iterparse(StringIO(data)):
+				_stripNamespace(element)
+				if element.tag == 'Error':
+					raise buildException(element)
+		status = getattr(usock, 'status', 200)
+		if status >= 500:
+			raise httpclient.HTTPError(url, status, usock.reason, usock)
+		return data
+
+	limiter = RATE_LIMITER
+	if limiter is None:
+		data = fetch()
+	else:
+		host = urlparse.urlsplit(url)[1]
+		account = __accountPattern.search(url)
+		data = limiter.call(host + ':' + (account and account.group(1) or ''), fetch, isTransient)
+	if cache is not None and ttl:
+		cache.set(key, data, ttl)
+	return XMLResponse(data)
 
 
 def rawObject(XMLSearch, arguments, kwItem, plugins=None):
 	'''Return a unique object'''
 
-	dom = XMLSearch(** arguments)
-	return unmarshal(dom.getElementsByTagName(kwItem).item(0), plugins) 
+	response = XMLSearch(** arguments)
+	return unmarshal(response.data, kwItem, plugins)
 
 	
 def rawIterator(XMLSearch, arguments, kwItems, plugins=None):
 	'''Return list of objects'''
 
-	dom = XMLSearch(** arguments)
-	items = unmarshal(dom.getElementsByTagName(kwItems).item(0), plugins, wrappedIterator())
+	response = XMLSearch(** arguments)
+	items = unmarshal(response.data, kwItems, plugins, wrappedIterator())
 	return items
 
 class wrappedIterator(list):
@@ -199,26 +332,46 @@ class wrappedIterator(list):
 	
 
 class pagedIterator:
-	'''Return a page-based iterator'''
+	'''Return a page-based iterator
 
-	def __init__(self, XMLSearch, arguments, kwPage, kwItems, plugins=None):
+	Parsed pages are kept in a small LRU cache, so going back and forth
+	between pages doesn't fetch them again, and while one page is read
+	the next is fetched in a background thread.'''
+
+	def __init__(self, XMLSearch, arguments, kwPage, kwItems, plugins=None, cachedPages=5, prefetch=True):
 		"""XMLSearch: the callback function that returns the DOM
 		arguments: the arguments for XMLSearch
 		kwPage, kwItems: Tag name of Page, Items to organize the object
 		plugins: please check unmarshal
+		cachedPages: how many parsed pages to keep
+		prefetch: whether to fetch the next page in the background
 		"""
 		self.__search = XMLSearch 
 		self.__arguments = arguments 
 		self.__keywords ={'Page':kwPage, 'Items':kwItems} 
 		self.__plugins = plugins
-		self.__page = arguments[kwPage] or 1
+		self.__prefetch = prefetch
+		self.__pages = LRUCache(cachedPages)
+		self.__lock = threading.Lock()
+		self.__fetching = {}
 		self.__index = 0
-		dom = self.__search(** self.__arguments)
-		self.__items = unmarshal(dom.getElementsByTagName(kwItems).item(0), plugins, wrappedIterator())
+		page = arguments[kwPage] or 1
+		items = self.__fetch(page)
+		try:
+			self.__len = int(items.TotalResults)
+		except (AttributeError, ValueError), e:
+			self.__len = len(items)
 		try:
-			self.__len = int(dom.getElementsByTagName("TotalResults").item(0).firstChild.data)
-		except AttributeError, e:
-			self.__len = len(self.__items)
+			self.__totalPages = int(items.TotalPages)
+		except (AttributeError, ValueError), e:
+			self.__totalPages = 1
+		# Every page but the last is full, so it tells the page size
+		if page < self.__totalPages and len(items):
+			self.__pageSize = len(items)
+		elif self.__totalPages == 1 and len(items):
+			self.__pageSize = len(items)
+		else:
+			self.__pageSize = 10
 
 	def __len__(self):
 		return self.__len
@@ -234,34 +387,92 @@ class pagedIterator:
 			raise StopIteration
 
 	def __getitem__(self, key):
+		if isinstance(key, slice):
+			# Only the pages holding the slice are fetched
+			return [self.__item(i, False) for i in range(*key.indices(self.__len))]
 		try:
 			num = int(key)
 		except TypeError, e:
 			raise e
 
-		if num >= self.__len:
+		if num < 0:
+			num += self.__len
+		if num < 0 or num >= self.__len:
 			raise IndexError
-
-		page = num / 10 + 1
-		index = num % 10
-		if page != self.__page:
-			self.__arguments[self.__keywords['Page']] = page
-			dom = self.__search(** self.__arguments)
-			self.__items = unmarshal(dom.getElementsByTagName(self.__keywords['Items']).item(0), self.__plugins, wrappedIterator())
-			self.__page = page
-
-		return self.__items[index]
-
-
-def unmarshal(element, plugins=None, rc=None):
-	"""Return the Bag object with attributes populated using DOM element
-
-	element: the root of the DOM element we are interested in
+		return self.__item(num, self.__prefetch)
+
+	def __item(self, num, prefetch):
+		page = num / self.__pageSize + 1
+		index = num % self.__pageSize
+		items = self.__pages.get(page)
+		if items is None:
+			self.__lock.acquire()
+			fetching = self.__fetching.get(page)
+			self.__lock.release()
+			if fetching:
+				fetching.wait()
+				items = self.__pages.get(page)
+			if items is None:
+				items = self.__fetch(page)
+		if prefetch:
+			self.__fetchInBackground(page + 1)
+		return items[index]
+
+	def __fetch(self, page):
+		arguments = dict(self.__arguments)
+		arguments[self.__keywords['Page']] = page
+		response = self.__search(** arguments)
+		items = unmarshal(response.data, self.__keywords['Items'], self.__plugins, wrappedIterator())
+		self.__pages.set(page, items)
+		return items
+
+	def __fetchInBackground(self, page):
+		if page > self.__totalPages:
+			return
+		self.__lock.acquire()
+		try:
+			if page in self.__fetching or self.__pages.get(page) is not None:
+				return
+			done = self.__fetching[page] = threading.Event()
+		finally:
+			self.__lock.release()
+
+		def fetch():
+			try:
+				try:
+					self.__fetch(page)
+				except Exception:
+					# Left for the reader to fetch, and see the error
+					pass
+			finally:
+				self.__lock.acquire()
+				del self.__fetching[page]
+				self.__lock.release()
+				done.set()
+		thread = threading.Thread(target=fetch)
+		thread.setDaemon(True)
+		thread.start()
+
+
+def _stripNamespace(element):
+	"""Drop the {namespace} prefix ElementTree puts on tag names"""
+	if element.tag[0] == '{':
+		element.tag = element.tag.split('}', 1)[1]
+
+
+def unmarshal(source, tagName, plugins=None, rc=None):
+	"""Return the Bag object with attributes populated from the first
+	tagName element of the XML in source
+
+	source: XML string, or file-like object, of the response
+	tagName: tag name of the element we are interested in
 	plugins: callback functions to fine-tune the object structure
-	rc: parent object, used in the recursive call
+	rc: object to populate, a new Bag by default
 
 	This core function is inspired by Mark Pilgrim (f8dy@diveintomark.org)
-	with some enhancement. Each node.tagName is evalued by plugins' callback
+	with some enhancement. The XML is parsed incrementally and the
+	objects are built in the same single pass, stopping at the end of
+	the tagName element. Each tag name is evalued by plugins' callback
 	functions:
 		
 		if plugins['isBypassed'] is true:
@@ -274,6 +485,9 @@ def unmarshal(element, plugins=None, rc=None):
 		if plugins['isCollected'] is true:
 			this children of elment is appended to grandparent
 			this object is ignored.
+
+	A tag repeated within one parent becomes a list of its objects.
+	An element without child elements becomes its text.
 	"""
 
 	if(rc == None):
@@ -281,231 +495,103 @@ def unmarshal(element, plugins=None, rc=None):
 
 	if(plugins == None):
 		plugins = {}
-
-	childElements = [e for e in element.childNodes if isinstance(e, minidom.Element)]
-
-	if childElements:
-		for child in childElements:
-			key = child.tagName
-			if hasattr(rc, key):
-				if type(getattr(rc, key)) <> type([]):
-					setattr(rc, key, [getattr(rc, key)])
-				setattr(rc, key, getattr(rc, key) + [unmarshal(child, plugins)])
-			elif isinstance(child, minidom.Element):
-				if plugins.has_key('isPivoted') and plugins['isPivoted'](child.tagName):
-						unmarshal(child, plugins, rc)
-				elif plugins.has_key('isBypassed') and plugins['isBypassed'](child.tagName):
-					continue
-				elif plugins.has_key('isCollective') and plugins['isCollective'](child.tagName):
-					setattr(rc, key, unmarshal(child, plugins, wrappedIterator([])))
-				elif plugins.has_key('isCollected') and plugins['isCollected'](child.tagName):
-					rc.append(unmarshal(child, plugins))
-				else:
-					setattr(rc, key, unmarshal(child, plugins))
-	else:
-		rc = "".join([e.data for e in element.childNodes if isinstance(e, minidom.Text)])
+	isPivoted = plugins.get('isPivoted')
+	isBypassed = plugins.get('isBypassed')
+	isCollective = plugins.get('isCollective')
+	isCollected = plugins.get('isCollected')
+
+	if isinstance(source, basestring):
+		source = StringIO(source)
+
+	# One frame per open element: [object, has child elements, how the
+	# object is attached to its parent, tag name]
+	stack = []
+	skipping = 0
+	for event, element in ElementTree.iterparse(source, ('start', 'end')):
+		if skipping:
+			# Inside a bypassed element
+			skipping += event == 'start' and 1 or -1
+			continue
+		if event == 'start':
+			_stripNamespace(element)
+			key = element.tag
+			if not stack:
+				if key == tagName:
+					stack.append([rc, False, None, key])
+				continue
+			parent = stack[-1]
+			parent[1] = True
+			if hasattr(parent[0], key):
+				stack.append([Bag(), False, 'repeated', key])
+			elif isPivoted and isPivoted(key):
+				stack.append([parent[0], False, 'pivoted', key])
+			elif isBypassed and isBypassed(key):
+				skipping = 1
+			elif isCollective and isCollective(key):
+				stack.append([wrappedIterator([]), False, 'attribute', key])
+			elif isCollected and isCollected(key):
+				stack.append([Bag(), False, 'collected', key])
+			else:
+				stack.append([Bag(), False, 'attribute', key])
+		elif stack:
+			obj, hasChildren, how, key = stack.pop()
+			if not hasChildren:
+				obj = element.text or ''
+			element.clear()
+			if not stack:
+				return obj
+			parent = stack[-1][0]
+			if how == 'repeated':
+				siblings = getattr(parent, key)
+				if type(siblings) <> type([]):
+					siblings = [siblings]
+					setattr(parent, key, siblings)
+				siblings.append(obj)
+			elif how == 'attribute':
+				setattr(parent, key, obj)
+			elif how == 'collected':
+				parent.append(obj)
+			# A pivoted element's children were put on its parent already
+		else:
+			element.clear()
 	return rc
 
 
 	
 # User interfaces
+#
+# Each operation is declared once in the table below, and both its
+# functions (foo, returning python objects, and XMLfoo, returning the
+# DOM) are generated from that entry when the module is imported.
+# Calling one binds the arguments with a dict merge and builds the
+# request URL with a single urlencode onto a prefix computed once per
+# operation and locale.
 
-def ItemLookup(ItemId, IdType=None, SearchIndex=None, MerchantId=None, Condition=None, DeliveryMethod=None, ISPUPostalCode=None, OfferPage=None, ReviewPage=None, VariationPage=None, ResponseGroup=None, AWSAccessKeyId=None): 
-	'''ItemLookup in ECS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isPivoted': lambda x: x == 'ItemAttributes', 
-		'isCollective': lambda x: x == 'Items', 
-		'isCollected': lambda x: x == 'Item'}
-	return pagedIterator(XMLItemLookup, argv, 'OfferPage', 'Items', plugins)
-
-	
-def XMLItemLookup(ItemId, IdType=None, SearchIndex=None, MerchantId=None, Condition=None, DeliveryMethod=None, ISPUPostalCode=None, OfferPage=None, ReviewPage=None, VariationPage=None, ResponseGroup=None, AWSAccessKeyId=None): 
-	'''DOM representation of ItemLookup in ECS'''
-
-	Operation = "ItemLookup"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
-
-
-def ItemSearch(Keywords, SearchIndex="Blended", Availability=None, Title=None, Power=None, BrowseNode=None, Artist=None, Author=None, Actor=None, Director=None, AudienceRating=None, Manufacturer=None, MusicLabel=None, Composer=None, Publisher=None, Brand=None, Conductor=None, Orchestra=None, TextStream=None, ItemPage=None, Sort=None, City=None, Cuisine=None, Neighborhood=None, MinimumPrice=None, MaximumPrice=None, MerchantId=None, Condition=None, DeliveryMethod=None, ResponseGroup=None, AWSAccessKeyId=None):  
-	'''ItemSearch in ECS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isPivoted': lambda x: x == 'ItemAttributes',
-		'isCollective': lambda x: x == 'Items', 
-		'isCollected': lambda x: x == 'Item'}
-	return pagedIterator(XMLItemSearch, argv, "ItemPage", 'Items', plugins)
-
-
-def XMLItemSearch(Keywords, SearchIndex="Blended", Availability=None, Title=None, Power=None, BrowseNode=None, Artist=None, Author=None, Actor=None, Director=None, AudienceRating=None, Manufacturer=None, MusicLabel=None, Composer=None, Publisher=None, Brand=None, Conductor=None, Orchestra=None, TextStream=None, ItemPage=None, Sort=None, City=None, Cuisine=None, Neighborhood=None, MinimumPrice=None, MaximumPrice=None, MerchantId=None, Condition=None, DeliveryMethod=None, ResponseGroup=None, AWSAccessKeyId=None):  
-	'''DOM representation of ItemSearch in ECS'''
-
-	Operation = "ItemSearch"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
-
-
-def SimilarityLookup(ItemId, SimilarityType=None, MerchantId=None, Condition=None, DeliveryMethod=None, ResponseGroup=None, AWSAccessKeyId=None):  
-	'''SimilarityLookup in ECS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isPivoted': lambda x: x == 'ItemAttributes',
-		'isCollective': lambda x: x == 'Items',
-		'isCollected': lambda x: x == 'Item'}
-	return rawIterator(XMLSimilarityLookup, argv, 'Items', plugins)
-
-
-def XMLSimilarityLookup(ItemId, SimilarityType=None, MerchantId=None, Condition=None, DeliveryMethod=None, ResponseGroup=None, AWSAccessKeyId=None):  
-	'''DOM representation of SimilarityLookup in ECS'''
-
-	Operation = "SimilarityLookup"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
-
-
-# List Operations
-
-def ListLookup(ListType, ListId, ProductPage=None, ProductGroup=None, Sort=None, MerchantId=None, Condition=None, DeliveryMethod=None, ResponseGroup=None, AWSAccessKeyId=None):  
-	'''ListLookup in ECS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isPivoted': lambda x: x == 'ItemAttributes',
-		'isCollective': lambda x: x == 'Lists', 
-		'isCollected': lambda x: x == 'List'}
-	return pagedIterator(XMLListLookup, argv, 'ProductPage', 'Lists', plugins)
-
-
-def XMLListLookup(ListType, ListId, ProductPage=None, ProductGroup=None, Sort=None, MerchantId=None, Condition=None, DeliveryMethod=None, ResponseGroup=None, AWSAccessKeyId=None):  
-	'''DOM representation of ListLookup in ECS'''
-
-	Operation = "ListLookup"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
-
-
-def ListSearch(ListType, Name=None, FirstName=None, LastName=None, Email=None, City=None, State=None, ListPage=None, ResponseGroup=None, AWSAccessKeyId=None):
-	'''ListSearch in ECS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isPivoted': lambda x: x == 'ItemAttributes',
-		'isCollective': lambda x: x == 'Lists', 
-		'isCollected': lambda x: x == 'List'}
-	return pagedIterator(XMLListSearch, argv, 'ListPage', 'Lists', plugins)
+__itemPlugins = {'isPivoted': lambda x: x == 'ItemAttributes',
+	'isCollective': lambda x: x == 'Items',
+	'isCollected': lambda x: x == 'Item'}
 
+__listPlugins = {'isPivoted': lambda x: x == 'ItemAttributes',
+	'isCollective': lambda x: x == 'Lists',
+	'isCollected': lambda x: x == 'List'}
 
-def XMLListSearch(ListType, Name=None, FirstName=None, LastName=None, Email=None, City=None, State=None, ListPage=None, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of ListSearch in ECS'''
+__cartPlugins = {'isBypassed': lambda x: x == 'Request',
+	'isCollective': lambda x: x in ('CartItems', 'SavedForLaterItems'),
+	'isCollected': lambda x: x in ('CartItem', 'SavedForLaterItem') }
 
-	Operation = "ListSearch"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
+__sellerListingPlugins = {'isBypassed': lambda x: x == 'Request',
+	'isCollective': lambda x: x == 'SellerListings',
+	'isCollected': lambda x: x == 'SellerListing'}
 
 
-#Remote Shopping Cart Operations
-def CartCreate(Items, Quantities, ResponseGroup=None, AWSAccessKeyId=None):
-	'''CartCreate in ECS'''
+def __paged(kwPage, kwItems, plugins):
+	return lambda XMLSearch, argv: pagedIterator(XMLSearch, argv, kwPage, kwItems, plugins)
 
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return __cartOperation(XMLCartCreate, argv)
+def __iterator(kwItems, plugins):
+	return lambda XMLSearch, argv: rawIterator(XMLSearch, argv, kwItems, plugins)
 
-
-def XMLCartCreate(Items, Quantities, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of CartCreate in ECS'''
-
-	Operation = "CartCreate"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	for x in ('Items', 'Quantities'):
-		del argv[x]
-
-	__fromListToItems(argv, Items, 'ASIN', Quantities)
-	return query(buildRequest(argv))
-
-
-def CartAdd(Cart, Items, Quantities, ResponseGroup=None, AWSAccessKeyId=None):
-	'''CartAdd in ECS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return __cartOperation(XMLCartAdd, argv)
-
-
-def XMLCartAdd(Cart, Items, Quantities, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of CartAdd in ECS'''
-
-	Operation = "CartAdd"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	CartId = Cart.CartId
-	HMAC = Cart.HMAC
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	for x in ('Items', 'Cart', 'Quantities'):
-		del argv[x]
-
-	__fromListToItems(argv, Items, 'ASIN', Quantities)
-	return query(buildRequest(argv))
-
-
-def CartGet(Cart, ResponseGroup=None, AWSAccessKeyId=None):
-	'''CartGet in ECS'''
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return __cartOperation(XMLCartGet, argv)
-
-
-def XMLCartGet(Cart, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of CartGet in ECS'''
-
-	Operation = "CartGet"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	CartId = Cart.CartId
-	HMAC = Cart.HMAC
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	del argv['Cart']
-	return query(buildRequest(argv))
-
-
-def CartModify(Cart, Items, Actions, ResponseGroup=None, AWSAccessKeyId=None):
-	'''CartModify in ECS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return __cartOperation(XMLCartModify, argv)
-
-
-def XMLCartModify(Cart, Items, Actions, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of CartModify in ECS'''
-	Operation = "CartModify"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	CartId = Cart.CartId
-	HMAC = Cart.HMAC
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	for x in ('Cart', 'Items', 'Actions'):
-		del argv[x]
-
-	__fromListToItems(argv, Items, 'CartItemId', Actions)
-	return query(buildRequest(argv))
-
-	
-def CartClear(Cart, ResponseGroup=None, AWSAccessKeyId=None):
-	'''CartClear in ECS'''
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return __cartOperation(XMLCartClear, argv)
-
-
-def XMLCartClear(Cart, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of CartClear in ECS'''
-
-	Operation = "CartClear"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	CartId = Cart.CartId
-	HMAC = Cart.HMAC
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	del argv['Cart']
-
-	return query(buildRequest(argv))
+def __object(kwItem, plugins):
+	return lambda XMLSearch, argv: rawObject(XMLSearch, argv, kwItem, plugins)
 
 
 def __fromListToItems(argv, items, id, actions):
@@ -520,181 +606,262 @@ def __fromListToItems(argv, items, id, actions):
 			argv["Item.%d.Action" % (i+1)] = action
 
 
-def __cartOperation(XMLSearch, arguments):
-	'''Generic cart operation'''
-
-	plugins = {'isBypassed': lambda x: x == 'Request',
-		'isCollective': lambda x: x in ('CartItems', 'SavedForLaterItems'),
-		'isCollected': lambda x: x in ('CartItem', 'SavedForLaterItem') }
-	return rawObject(XMLSearch, arguments, 'Cart', plugins)
-
+def __fromCart(argv):
+	'''Replace the Cart argument by its CartId and HMAC'''
 
-# Seller Operation
-def SellerLookup(Sellers, ResponseGroup=None, AWSAccessKeyId=None):
-	'''SellerLookup in AWS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isBypassed': lambda x: x == 'Request',
-		'isCollective': lambda x: x == 'Sellers',
-		'isCollected': lambda x: x == 'Seller'}
-	return rawIterator(XMLSellerLookup, argv, 'Sellers', plugins)
+	cart = argv.pop('Cart')
+	argv['CartId'] = cart.CartId
+	argv['HMAC'] = cart.HMAC
 
 
-def XMLSellerLookup(Sellers, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of SellerLookup in AWS'''
+def __prepareCartItems(argv):
+	__fromListToItems(argv, argv.pop('Items'), 'ASIN', argv.pop('Quantities'))
 
-	Operation = "SellerLookup"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	SellerId = ",".join(Sellers)
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	del argv['Sellers']
-	return query(buildRequest(argv))
+def __prepareCartAdd(argv):
+	__fromCart(argv)
+	__prepareCartItems(argv)
 
+def __prepareCartModify(argv):
+	__fromCart(argv)
+	__fromListToItems(argv, argv.pop('Items'), 'CartItemId', argv.pop('Actions'))
 
-def SellerListingLookup(SellerId, Id, IdType="Listing", ResponseGroup=None, AWSAccessKeyId=None):
-	'''SellerListingLookup in AWS
-
-	Notice: although the repsonse includes TotalPage, TotalResults, 
-	there is no ListingPage in the request, so we have to use rawIterator
-	instead of pagedIterator. Hope Amazaon would fix this inconsistance'''
-	
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isBypassed': lambda x: x == 'Request',
-		'isCollective': lambda x: x == 'SellerListings', 
-		'isCollected': lambda x: x == 'SellerListing'}
-	return rawIterator(XMLSellerListingLookup, argv, "SellerListings", plugins)
+def __prepareSellers(argv):
+	argv['SellerId'] = ",".join(argv.pop('Sellers'))
 
 
-def XMLSellerListingLookup(SellerId, Id, IdType="Listing", ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of SellerListingLookup in AWS'''
+# (Operation, parameters in positional order -- those before the '|'
+# are required -- non-None defaults, how results are unmarshalled,
+# function to turn the arguments into request parameters)
+__operations = (
+	('ItemLookup', 'ItemId | IdType SearchIndex MerchantId Condition DeliveryMethod ISPUPostalCode OfferPage ReviewPage VariationPage',
+		{}, __paged('OfferPage', 'Items', __itemPlugins), None),
+	('ItemSearch', 'Keywords | SearchIndex Availability Title Power BrowseNode Artist Author Actor Director AudienceRating Manufacturer MusicLabel Composer Publisher Brand Conductor Orchestra TextStream ItemPage Sort City Cuisine Neighborhood MinimumPrice MaximumPrice MerchantId Condition DeliveryMethod',
+		{'SearchIndex': "Blended"}, __paged('ItemPage', 'Items', __itemPlugins), None),
+	('SimilarityLookup', 'ItemId | SimilarityType MerchantId Condition DeliveryMethod',
+		{}, __iterator('Items', __itemPlugins), None),
 
-	Operation = "SellerListingLookup"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
+	# List Operations
+	('ListLookup', 'ListType ListId | ProductPage ProductGroup Sort MerchantId Condition DeliveryMethod',
+		{}, __paged('ProductPage', 'Lists', __listPlugins), None),
+	('ListSearch', 'ListType | Name FirstName LastName Email City State ListPage',
+		{}, __paged('ListPage', 'Lists', __listPlugins), None),
 
+	#Remote Shopping Cart Operations
+	('CartCreate', 'Items Quantities |', {}, __object('Cart', __cartPlugins), __prepareCartItems),
+	('CartAdd', 'Cart Items Quantities |', {}, __object('Cart', __cartPlugins), __prepareCartAdd),
+	('CartGet', 'Cart |', {}, __object('Cart', __cartPlugins), __fromCart),
+	('CartModify', 'Cart Items Actions |', {}, __object('Cart', __cartPlugins), __prepareCartModify),
+	('CartClear', 'Cart |', {}, __object('Cart', __cartPlugins), __fromCart),
 
-def SellerListingSearch(SellerId, Title=None, Sort=None, ListingPage=None, OfferStatus=None, ResponseGroup=None, AWSAccessKeyId=None):
-	'''SellerListingSearch in AWS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isBypassed': lambda x: x == 'Request',
-		'isCollective': lambda x: x == 'SellerListings', 
-		'isCollected': lambda x: x == 'SellerListing'}
-	return pagedIterator(XMLSellerListingSearch, argv, "ListingPage", "SellerListings", plugins)
-
-
-def XMLSellerListingSearch(SellerId, Title=None, Sort=None, ListingPage=None, OfferStatus=None, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of SellerListingSearch in AWS'''
-
-	Operation = "SellerListingSearch"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
-
-
-def CustomerContentSearch(Name=None, Email=None, CustomerPage=1, ResponseGroup=None, AWSAccessKeyId=None):
-	'''CustomerContentSearch in AWS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isBypassed': lambda x: x == 'Request',
+	# Seller Operation
+	('SellerLookup', 'Sellers |', {}, __iterator('Sellers',
+		{'isBypassed': lambda x: x == 'Request',
+		'isCollective': lambda x: x == 'Sellers',
+		'isCollected': lambda x: x == 'Seller'}), __prepareSellers),
+	# Although the response includes TotalPage, TotalResults, there is
+	# no ListingPage in the request, so rawIterator is used instead of
+	# pagedIterator. Hope Amazaon would fix this inconsistance
+	('SellerListingLookup', 'SellerId Id | IdType',
+		{'IdType': "Listing"}, __iterator('SellerListings', __sellerListingPlugins), None),
+	('SellerListingSearch', 'SellerId | Title Sort ListingPage OfferStatus',
+		{}, __paged('ListingPage', 'SellerListings', __sellerListingPlugins), None),
+	('CustomerContentSearch', '| Name Email CustomerPage', {'CustomerPage': 1}, __iterator('Customers',
+		{'isBypassed': lambda x: x == 'Request',
 		'isCollective': lambda x: x in ('Customers', 'CustomerReviews'),
-		'isCollected': lambda x: x in ('Customer', 'Review')}
-	return rawIterator(XMLCustomerContentSearch, argv, 'Customers', plugins)
-
-
-def XMLCustomerContentSearch(Name=None, Email=None, CustomerPage=1, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of CustomerContentSearch in AWS'''
-
-	Operation = "CustomerContentSearch"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	for x in ('Name', 'Email'):
-		if not argv[x]:
-			del argv[x]
-	return query(buildRequest(argv))
-
-
-def CustomerContentLookup(CustomerId, ReviewPage=1, ResponseGroup=None, AWSAccessKeyId=None):
-	'''CustomerContentLookup in AWS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isBypassed': lambda x: x == 'Request',
+		'isCollected': lambda x: x in ('Customer', 'Review')}), None),
+	('CustomerContentLookup', 'CustomerId | ReviewPage', {'ReviewPage': 1}, __iterator('Customers',
+		{'isBypassed': lambda x: x == 'Request',
 		'isCollective': lambda x: x == 'Customers',
-		'isCollected': lambda x: x == 'Customer'}
-	return rawIterator(XMLCustomerContentLookup, argv, 'Customers', plugins)
-
-
-def XMLCustomerContentLookup(CustomerId, ReviewPage=1, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of CustomerContentLookup in AWS'''
+		'isCollected': lambda x: x == 'Customer'}), None),
 
-	Operation = "CustomerContentLookup"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
-
-
-# BrowseNode
-def BrowseNodeLookup(BrowseNodeId, ResponseGroup=None, AWSAccessKeyId=None):
-	'''BrowseNodeLookup in AWS'''
-
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isBypassed': lambda x: x == 'Request',
+	# BrowseNode
+	('BrowseNodeLookup', 'BrowseNodeId |', {}, __iterator('BrowseNodes',
+		{'isBypassed': lambda x: x == 'Request',
 		'isCollective': lambda x: x == 'Children',
-		'isCollected': lambda x: x == 'BrowseNode'}
-	return rawIterator(XMLBrowseNodeLookup, argv, 'BrowseNodes', plugins)
-
-
-def XMLBrowseNodeLookup(BrowseNodeId, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of BrowseNodeLookup in AWS'''
-	
-	Operation = "BrowseNodeLookup"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
-
-
-# Help
-def Help(HelpType, About, ResponseGroup=None, AWSAccessKeyId=None):
-	'''Help in AWS'''
+		'isCollected': lambda x: x == 'BrowseNode'}), None),
 
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isBypassed': lambda x: x == 'Request', 
-		'isCollective': lambda x: x in ('RequiredParameters', 
+	# Help
+	('Help', 'HelpType About |', {}, __object('Information',
+		{'isBypassed': lambda x: x == 'Request',
+		'isCollective': lambda x: x in ('RequiredParameters',
 			'AvailableParameters', 'DefaultResponseGroups',
 			'AvailableResponseGroups'),
-		'isCollected': lambda x: x in ('Parameter', 'ResponseGroup') }
-	return rawObject(XMLHelp, argv, 'Information', plugins)
-
-
-def XMLHelp(HelpType, About, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of Help in AWS'''
-
-	Operation = "Help"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
+		'isCollected': lambda x: x in ('Parameter', 'ResponseGroup') }), None),
 
+	# Transaction
+	('TransactionLookup', 'TransactionId |', {}, __iterator('Transactions',
+		{'isBypassed': lambda x: x == 'Request',
+		'isCollective': lambda x: x in ('Transactions', 'TransactionItems', 'Shipments'),
+		'isCollected': lambda x: x in ('Transaction', 'TransactionItem', 'Shipment')}), None),
+)
 
-# Transaction
-def TransactionLookup(TransactionId, ResponseGroup=None, AWSAccessKeyId=None):
-	'''TransactionLookup in AWS'''
 
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	plugins = {'isBypassed': lambda x: x == 'Request', 
-		'isCollective': lambda x: x in ('Transactions', 'TransactionItems', 'Shipments'),
-		'isCollected': lambda x: x in ('Transaction', 'TransactionItem', 'Shipment')}
-			
-	return rawIterator(XMLTransactionLookup, argv, 'Transactions', plugins)
-	
+__required = object()
 
-def XMLTransactionLookup(TransactionId, ResponseGroup=None, AWSAccessKeyId=None):
-	'''DOM representation of TransactionLookup in AWS'''
+def __makeBinder(operation, params, defaults):
+	'''Return a function binding positional and keyword arguments to a
+	dict of all the operation's parameters'''
+
+	allDefaults = dict.fromkeys(params)
+	allDefaults.update(defaults)
+
+	def bind(args, kwargs):
+		if len(args) > len(params):
+			raise TypeError("%s() takes at most %d arguments (%d given)" %
+				(operation, len(params), len(args)))
+		argv = allDefaults.copy()
+		argv.update(zip(params, args))
+		for key in kwargs:
+			if key not in allDefaults:
+				raise TypeError("%s() got an unexpected keyword argument '%s'" %
+					(operation, key))
+		argv.update(kwargs)
+		if __required in argv.itervalues():
+			missing = [p for p in params if argv[p] is __required]
+			raise TypeError("%s() missing required argument(s): %s" %
+				(operation, ', '.join(missing)))
+		return argv
+	return bind
+
+
+def __makeOperation(operation, signature, defaults, wrap, prepare):
+	required, optional = [s.split() for s in signature.split('|')]
+	params = required + optional + ['ResponseGroup', 'AWSAccessKeyId']
+	defaults = dict(defaults)
+	defaults.update(dict.fromkeys(required, __required))
+	bind = __makeBinder(operation, params, defaults)
+	prototype = "%s(%s)" % (operation, ', '.join(required +
+		['%s=%r' % (p, defaults.get(p)) for p in params[len(required):]]))
+
+	def XMLOperation(*args, **kwargs):
+		argv = bind(args, kwargs)
+		argv['AWSAccessKeyId'] = argv['AWSAccessKeyId'] or LICENSE_KEY
+		if prepare:
+			prepare(argv)
+		return query(__operationURL(operation) + __encode(argv))
+	XMLOperation.__name__ = 'XML' + operation
+	XMLOperation.__doc__ = '%s\n\nDOM representation of %s in ECS' % (prototype, operation)
+
+	def Operation(*args, **kwargs):
+		return wrap(XMLOperation, bind(args, kwargs))
+	Operation.__name__ = operation
+	Operation.__doc__ = '%s\n\n%s in ECS' % (prototype, operation)
+
+	return Operation, XMLOperation
+
+
+__unsafe = re.compile(r'[^A-Za-z0-9_.~-]')
+
+def __encode(argv):
+	'''urlencode the true values of argv, only quoting those that need it'''
+
+	pairs = []
+	for (k, v) in argv.iteritems():
+		if v:
+			v = str(v)
+			if __unsafe.search(v):
+				v = urllib.quote_plus(v)
+			pairs.append(k + '=' + v)
+	return '&'.join(pairs)
+
+
+__operationURLs = {}
+
+def __operationURL(operation):
+	'''Return the request URL prefix of operation in the current locale'''
+
+	key = (LOCALE, operation)
+	try:
+		return __operationURLs[key]
+	except KeyError:
+		url = __operationURLs[key] = "http://%s/onca/xml?Service=AWSECommerceService&Operation=%s&" % (
+			__supportedLocales[LOCALE], operation)
+		return url
+
+
+for __entry in __operations:
+	globals()[__entry[0]], globals()['XML' + __entry[0]] = __makeOperation(* __entry)
+del __entry
+
+
+# Batch lookup
+
+# Most ItemIds one ItemLookup request accepts
+MAX_ITEM_IDS = 10
+
+def __normalizeId(id):
+	return str(id).replace('-', '').replace(' ', '').upper()
+
+def __itemIds(item, IdType):
+	'''Return the normalized ids of IdType an unmarshalled item answers to'''
 
-	Operation = "TransactionLookup"
-	AWSAccessKeyId = AWSAccessKeyId or LICENSE_KEY
-	argv = inspect.getargvalues(inspect.currentframe())[-1]
-	return query(buildRequest(argv))
+	if IdType in (None, 'ASIN'):
+		names = ('ASIN',)
+	elif IdType == 'ISBN':
+		# ISBN-13s come back as the EAN
+		names = ('ISBN', 'EAN')
+	else:
+		names = (IdType,)
+	ids = set()
+	for name in names:
+		values = getattr(item, name, None) or []
+		if not isinstance(values, list):
+			values = [values]
+		ids.update(__normalizeId(v) for v in values)
+	return ids
+
+
+def ItemLookupMany(ids, IdType=None, SearchIndex=None, ResponseGroup=None, AWSAccessKeyId=None, workers=httpclient.MAX_PER_HOST, **kwargs):
+	'''ItemLookup of many ItemIds, MAX_ITEM_IDS per request
+
+	The requests are sent from at most workers threads at once. Returns
+	a list holding an (id, item, error) triple for each of ids, in the
+	same order: item is the unmarshalled Item, or None and error the
+	exception explaining why. A request that fails as a whole (one bad
+	id makes Amazon reject all of them) is retried one id at a time, so
+	the error lands on the id it belongs to. Other ItemLookup arguments
+	can be passed as keywords.'''
+
+	ids = list(ids)
+	unique = []
+	seen = set()
+	for id in ids:
+		if id not in seen:
+			seen.add(id)
+			unique.append(id)
+	kwargs.update(IdType=IdType, SearchIndex=SearchIndex,
+		ResponseGroup=ResponseGroup, AWSAccessKeyId=AWSAccessKeyId)
+
+	def lookup(chunk):
+		response = XMLItemLookup(",".join([str(id) for id in chunk]), **kwargs)
+		items = unmarshal(response.data, 'Items', __itemPlugins, wrappedIterator())
+		found = {}
+		for item in items:
+			for key in __itemIds(item, IdType):
+				found.setdefault(key, item)
+		return found
+
+	chunks = [unique[i:i+MAX_ITEM_IDS] for i in range(0, len(unique), MAX_ITEM_IDS)]
+	results = {}
+	retry = []
+	for chunk, (found, error) in zip(chunks, parallel_map(lookup, chunks, workers)):
+		if error is not None:
+			if len(chunk) > 1:
+				retry.extend(chunk)
+				continue
+			found = {}
+		for id in chunk:
+			results[id] = (found.get(__normalizeId(id)), error)
+	for id, (found, error) in zip(retry, parallel_map(lookup, [[id] for id in retry], workers)):
+		results[id] = ((found or {}).get(__normalizeId(id)), error)
+
+	rc = []
+	for id in ids:
+		item, error = results[id]
+		if item is None and error is None:
+			error = InvalidParameterValue("%s is not a valid value for ItemId." % id)
+		rc.append((id, item, error))
+	return rc
 
 
 
@@ -0,0 +1,168 @@
+"""
+Streaming export of the catalogue as JSON lines, CSV or Atom.
+
+Books are read in chunks of CHUNK_SIZE, seeking by id, with their
+categories and recommendations fetched per chunk, and every format is
+written as a generator of strings. So an export holds one chunk in
+memory however big the catalogue is, and the view can hand the
+generator straight to an HttpResponse.
+
+    for chunk in export.export('jsonl'):
+        out.write(chunk)
+"""
+import csv
+import datetime
+import time
+from cStringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
+from django.db import connection
+from django.utils import simplejson
+from models import Book, CatalogueVersion, Category, Recommendation
+
+CHUNK_SIZE = 500
+
+CONTENT_TYPES = {'jsonl': 'application/x-ndjson; charset=utf-8',
+                 'csv': 'text/csv; charset=utf-8',
+                 'atom': 'application/atom+xml; charset=utf-8'}
+
+CSV_COLUMNS = ('gid', 'isbn', 'title', 'authors', 'url', 'added', 'edited',
+               'categories', 'recommended_by', 'comments')
+
+
+def export(format, books=None, link=u'/'):
+    """
+    Return a generator of the catalogue, or of books, in format. link
+    is the absolute URL of the book list, which Atom feeds need.
+    """
+    records = iter_records(books)
+    if format == 'jsonl':
+        return jsonl(records)
+    if format == 'csv':
+        return csv_rows(records)
+    if format == 'atom':
+        return atom_feed(records, u'Informatics Book List', link,
+                         CatalogueVersion.current().changed)
+    raise ValueError("Unknown export format %r" % format)
+
+
+def iter_records(books=None):
+    """
+    Yield a dict for each Book of books (all of them by default), in
+    id order, with its category slugs and recommendations.
+    """
+    if books is None:
+        books = Book.objects.all()
+    slugs = dict(Category.objects.values_list('id', 'slug'))
+    last_id = 0
+    while True:
+        chunk = list(books.filter(id__gt=last_id).order_by('id')[:CHUNK_SIZE])
+        if not chunk:
+            return
+        for record in records(chunk, slugs):
+            yield record
+        last_id = chunk[-1].id
+
+
+def records(books, slugs=None):
+    """
+    Return a list of records like iter_records() yields for a list of
+    books, in the same order, from two queries.
+    """
+    if slugs is None:
+        slugs = dict(Category.objects.values_list('id', 'slug'))
+    ids = [b.id for b in books]
+    if not ids:
+        return []
+    categories = dict((id, []) for id in ids)
+    for book_id, category_id in _memberships(ids):
+        categories[book_id].append(slugs[category_id])
+    recommendations = dict((id, []) for id in ids)
+    for book_id, username, comment, added in Recommendation.objects \
+            .filter(book__in=ids).order_by('added') \
+            .values_list('book', 'user__username', 'comment', 'added').iterator():
+        recommendations[book_id].append({'user': username,
+                                         'comment': comment,
+                                         'added': added})
+    return [{'gid': b.gid, 'isbn': b.isbn, 'title': b.title,
+             'authors': b.authors, 'url': b.url(),
+             'added': b.added, 'edited': b.edited,
+             'categories': sorted(categories[b.id]),
+             'recommendations': recommendations[b.id]}
+            for b in books]
+
+
+def _memberships(book_ids):
+    """Return (book id, category id) pairs for the books, in one query."""
+    field = Category._meta.get_field('books')
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s, %s FROM %s WHERE %s IN (%s)' % (
+                       qn(field.m2m_reverse_name()), qn(field.m2m_column_name()),
+                       qn(field.m2m_db_table()), qn(field.m2m_reverse_name()),
+                       ', '.join(['%s'] * len(book_ids))),
+                   book_ids)
+    return cursor.fetchall()
+
+
+def jsonl(records):
+    """Yield each record as a line of JSON, with ISO 8601 times."""
+    for r in records:
+        yield simplejson.dumps(r, default=_isoformat) + '\n'
+
+
+def _isoformat(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def csv_rows(records):
+    """
+    Yield a CSV header line, then a line per record. Categories and
+    recommending users are ';'-separated; comments are one per line,
+    each after its user's name.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_COLUMNS)
+    for r in records:
+        row = dict(r)
+        row['categories'] = ';'.join(r['categories'])
+        row['recommended_by'] = ';'.join(rec['user'] for rec in r['recommendations'])
+        row['comments'] = '\n'.join(u'%s: %s' % (rec['user'], rec['comment'])
+                                    for rec in r['recommendations'] if rec['comment'])
+        row['added'] = r['added'].isoformat()
+        row['edited'] = r['edited'].isoformat()
+        writer.writerow([unicode(row[c] or '').encode('utf-8') for c in CSV_COLUMNS])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def atom_feed(records, title, link, updated):
+    """
+    Yield an Atom feed, titled title and linking to link, with an entry
+    per record. updated is when the feed as a whole last changed.
+    """
+    yield (u'<?xml version="1.0" encoding="utf-8"?>\n'
+           u'<feed xmlns="http://www.w3.org/2005/Atom">\n'
+           u'<title>%s</title>\n<link href=%s/>\n<id>%s</id>\n'
+           u'<updated>%s</updated>\n' % (
+               escape(title), quoteattr(link), escape(link),
+               _rfc3339(updated))).encode('utf-8')
+    for r in records:
+        comments = u''.join(u'<p>%s: %s</p>' % (escape(rec['user']), escape(rec['comment']))
+                            for rec in r['recommendations'] if rec['comment'])
+        yield (u'<entry>\n<title>%s</title>\n<link href=%s/>\n<id>%s</id>\n'
+               u'<updated>%s</updated>\n<author><name>%s</name></author>\n'
+               u'%s<content type="html">%s</content>\n</entry>\n' % (
+                   escape(r['title']), quoteattr(r['url']), escape(r['url']),
+                   _rfc3339(r['edited']), escape(r['authors']),
+                   u''.join(u'<category term=%s/>' % quoteattr(c) for c in r['categories']),
+                   escape(comments))).encode('utf-8')
+    yield '</feed>\n'
+
+
+def _rfc3339(stamp):
+    """Return a naive local datetime as an RFC 3339 UTC time."""
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.mktime(stamp.timetuple())))
@@ -1,7 +1,12 @@
 import sys
 import urllib
 import utils
-from elementtree import ElementTree
+import httpclient
+import ratelimit
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from elementtree import ElementTree
 
 
 class Book(object):
@@ -15,86 +20,176 @@ class Book(object):
         self.link = link
 
 
+# Parsed results of get() and search() are kept here, keyed by gid or
+# normalized query. Any object with get(key, default) and
+# set(key, value, ttl) methods will do; set to None to disable caching.
+cache = utils.LRUCache(max_size=2000, ttl=60*60)
+# Empty results and failed lookups are remembered for this long.
+NEGATIVE_TTL = 5*60
+_MISSING = object()
+
+# Requests to Google Books are spread out by this ratelimit.RateLimiter,
+# and retried when throttled; set to None to send them unchecked.
+limiter = ratelimit.RateLimiter(rate=5, burst=5)
+
+
+class _Failure(object):
+    """A cached failed lookup; re-raises the original error."""
+    def __init__(self, error):
+        self.error = error
+
+
+def _cached(key, fetch):
+    if cache is None:
+        return fetch()
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        try:
+            value = fetch()
+        except Exception, e:
+            cache.set(key, _Failure(e), NEGATIVE_TTL)
+            raise
+        cache.set(key, value, not value and NEGATIVE_TTL or None)
+    elif isinstance(value, _Failure):
+        raise value.error
+    return value
+
+
+def _is_transient(error):
+    return isinstance(error, httpclient.HTTPError) and \
+           (error.status == 429 or error.status >= 500)
+
+
+def _urlopen(url):
+    if limiter is None:
+        return httpclient.urlopen(url)
+    return limiter.call('books.google.com', lambda: httpclient.urlopen(url),
+                        _is_transient)
+
+
 def get(gid):
-    openurl = urllib.urlopen('http://books.google.com/books/feeds/volumes/'+gid)
-    try:
-        parsed = _parse_url(openurl)
-        assert len(parsed) == 1
-        return parsed[0]
-    finally:
-        openurl.close()
+    def fetch():
+        openurl = _urlopen('http://books.google.com/books/feeds/volumes/'+gid)
+        try:
+            parsed = _parse_url(openurl)
+            assert len(parsed) == 1
+            return parsed[0]
+        finally:
+            openurl.close()
+    return _cached('get:'+gid, fetch)
+
+
+def get_many(gids, workers=httpclient.MAX_PER_HOST):
+    """
+    Look up many volumes at once, using up to `workers` threads.
+    Returns a list of (gid, Book, None) for each gid found and
+    (gid, None, exception) for each that failed, in the order given.
+    """
+    gids = list(gids)
+    results = utils.parallel_map(get, gids, workers)
+    return [(gid, book, error) for gid, (book, error) in zip(gids, results)]
 
 
 def search(query):
-    p = urllib.urlencode({'q': query, 'max-results': '20'})
-    openurl = urllib.urlopen('http://books.google.com/books/feeds/volumes?'+p)
-    try:
-        return _parse_url(openurl)
-    finally:
-        openurl.close()
+    query = ' '.join(query.lower().split())
+    def fetch():
+        p = urllib.urlencode({'q': query, 'max-results': '20'})
+        openurl = _urlopen('http://books.google.com/books/feeds/volumes?'+p)
+        try:
+            return _parse_url(openurl)
+        finally:
+            openurl.close()
+    return list(_cached('search:'+query, fetch))
 
 
 def _parse_url(openurl):
-    def gimmeall(tree):
-        if tree.getroot().tag == '{http://www.w3.org/2005/Atom}entry':
-            return [tree.getroot()]
-        else:
-            return tree.findall('{http://www.w3.org/2005/Atom}entry')
-    out = []
-    for e in gimmeall(ElementTree.parse(openurl)):
-        info_eles = [c for c in e.findall('{http://www.w3.org/2005/Atom}link')
-                     if c.attrib['rel'] == 'http://schemas.google.com/books/2008/info']
-        if len(info_eles) > 0:
-            info = info_eles[0].attrib['href']
-            if len(info_eles) > 1:
-                print >>sys.stderr, 'Multiple info URLs found. Saved first one'
-        else:
-            info = None
-            print >>sys.stderr, 'No info URL found found'
-        
-        isbn13_eles = [c for c in e.findall('{http://purl.org/dc/terms}identifier')
-                       if c.text.upper().startswith('ISBN:') and len(c.text) == 13+5]
-        isbn10_eles = [c for c in e.findall('{http://purl.org/dc/terms}identifier')
-                       if c.text.upper().startswith('ISBN:') and len(c.text) == 10+5]
-        if len(isbn13_eles) > 0:
-            isbn = isbn13_eles[0].text[5:]
-            if len(isbn13_eles) > 1:
-                print >>sys.stderr, 'Multiple ISBN-13 idents found. Saved first one'
-                print >>sys.stderr, 'They were', repr([x.text for x in isbn13_eles])
-        elif len(isbn10_eles) > 0:
-            isbn = isbn10_eles[0].text[5:]
-            if len(isbn10_eles) > 1:
-                print >>sys.stderr, 'No ISBN-13 and multiple ISBN-10 idents found. Saved first one'
-                print >>sys.stderr, 'They were', repr([x.text for x in isbn10_eles])
-        else:
-            isbn = None
-        
-        gid_eles = [c for c in e.findall('{http://purl.org/dc/terms}identifier')
-                    if ':' not in c.text]
-        if len(gid_eles) > 0:
-            gid = gid_eles[0].text
-            if len(gid_eles) > 1:
-                print >>sys.stderr, 'Multiple GIDs found. Saved first one'
-                print >>sys.stderr, 'They were', repr([repr(x.text) for x in gid_eles])
-        else:
-            gid = None
-            print >>sys.stderr, 'No GID found'
-        
-        title = e.findtext('{http://www.w3.org/2005/Atom}title')
-        author_list = [x.text for x in e.findall('{http://purl.org/dc/terms}creator')]
-        authors = utils.english_list(author_list)
-        
-        print 'all links', [(c.attrib['rel'], c.attrib['href']) for c in e.findall('{http://www.w3.org/2005/Atom}link')]
-        img_links = [c for c in e.findall('{http://www.w3.org/2005/Atom}link')
-                     if c.attrib['rel'] == 'http://schemas.google.com/books/2008/thumbnail']
-        if len(img_links) > 0:
-            img_url = img_links[0].attrib['href']
-            if len(img_links) > 1:
-                print >>sys.stderr, 'Multiple image links found. Taking first one as cover'
-        else:
-            img_url = None
-        out.append(Book(title, authors, img_url, isbn, gid, link=info))
-    return out
+    return list(_iter_books(openurl))
+
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+DC = '{http://purl.org/dc/terms}'
+INFO_REL = 'http://schemas.google.com/books/2008/info'
+THUMBNAIL_REL = 'http://schemas.google.com/books/2008/thumbnail'
+
+
+def _iter_books(source):
+    """
+    Yield a Book for each entry of the Atom feed (or lone entry) read
+    from source, as soon as that entry has been parsed. Finished
+    entries are cleared, so memory use doesn't grow with the feed.
+    """
+    for event, elem in ElementTree.iterparse(source):
+        if elem.tag == ATOM+'entry':
+            yield _entry_to_book(elem)
+
+
+def _entry_to_book(e):
+    """Build a Book from an Atom entry element in one pass over its children."""
+    title = None
+    author_list = []
+    isbn13s, isbn10s, gids = [], [], []
+    infos, img_urls = [], []
+    for c in e:
+        if c.tag == DC+'identifier':
+            text = c.text or ''
+            if text[:5].upper() == 'ISBN:':
+                if len(text) == 13+5:
+                    isbn13s.append(text[5:])
+                elif len(text) == 10+5:
+                    isbn10s.append(text[5:])
+            elif text and ':' not in text:
+                gids.append(text)
+        elif c.tag == DC+'creator':
+            author_list.append(c.text)
+        elif c.tag == ATOM+'link':
+            rel = c.get('rel')
+            if rel == INFO_REL:
+                infos.append(c.get('href'))
+            elif rel == THUMBNAIL_REL:
+                img_urls.append(c.get('href'))
+        elif c.tag == ATOM+'title' and title is None:
+            title = c.text or ''
+
+    if len(infos) > 0:
+        info = infos[0]
+        if len(infos) > 1:
+            print >>sys.stderr, 'Multiple info URLs found. Saved first one'
+    else:
+        info = None
+        print >>sys.stderr, 'No info URL found found'
+
+    if len(isbn13s) > 0:
+        isbn = isbn13s[0]
+        if len(isbn13s) > 1:
+            print >>sys.stderr, 'Multiple ISBN-13 idents found. Saved first one'
+            print >>sys.stderr, 'They were', repr(isbn13s)
+    elif len(isbn10s) > 0:
+        isbn = isbn10s[0]
+        if len(isbn10s) > 1:
+            print >>sys.stderr, 'No ISBN-13 and multiple ISBN-10 idents found. Saved first one'
+            print >>sys.stderr, 'They were', repr(isbn10s)
+    else:
+        isbn = None
+
+    if len(gids) > 0:
+        gid = gids[0]
+        if len(gids) > 1:
+            print >>sys.stderr, 'Multiple GIDs found. Saved first one'
+            print >>sys.stderr, 'They were', repr(gids)
+    else:
+        gid = None
+        print >>sys.stderr, 'No GID found'
+
+    if len(img_urls) > 0:
+        img_url = img_urls[0]
+        if len(img_urls) > 1:
+            print >>sys.stderr, 'Multiple image links found. Taking first one as cover'
+    else:
+        img_url = None
+
+    authors = utils.english_list(author_list)
+    e.clear()
+    return Book(title, authors, img_url, isbn, gid, link=info)
 
 
 if __name__ == '__main__':
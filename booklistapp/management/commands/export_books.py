@@ -0,0 +1,26 @@
+import sys
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from infxbooklist.booklistapp import export
+
+
+class Command(NoArgsCommand):
+    help = "Write the whole catalogue, with categories and recommendations, as JSON lines, CSV or Atom."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', dest='format', default='jsonl',
+                    choices=sorted(export.CONTENT_TYPES.keys()),
+                    help="jsonl (the default), csv or atom."),
+        make_option('--output', '-o', dest='output',
+                    help="File to write; by default, standard output."),
+        make_option('--link', dest='link', default='http://localhost/',
+                    help="Absolute URL of the book list, for Atom feeds."),
+    )
+
+    def handle_noargs(self, **options):
+        out = options['output'] and open(options['output'], 'wb') or sys.stdout
+        try:
+            for chunk in export.export(options['format'], link=options['link']):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
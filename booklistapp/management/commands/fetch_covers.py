@@ -0,0 +1,39 @@
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from infxbooklist.booklistapp import covers
+from settings import COVER_FETCH_TIMEOUT, COVER_FETCH_CONCURRENCY, \
+                     COVER_FETCH_MAX_ATTEMPTS
+
+
+class Command(NoArgsCommand):
+    help = "Download queued book covers. Runs until killed unless --once is given."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Work through the covers that are due, then exit.'),
+        make_option('--concurrency', type='int', dest='concurrency',
+                    default=COVER_FETCH_CONCURRENCY,
+                    help='Number of simultaneous downloads.'),
+        make_option('--timeout', type='float', dest='timeout',
+                    default=COVER_FETCH_TIMEOUT,
+                    help='Seconds to wait on a cover host.'),
+        make_option('--max-attempts', type='int', dest='max_attempts',
+                    default=COVER_FETCH_MAX_ATTEMPTS,
+                    help='Give up on a cover after this many failures.'),
+        make_option('--poll', type='float', dest='poll', default=5,
+                    help='Seconds to sleep when nothing is due.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            fetched, failed = covers.run_once(
+                concurrency=options['concurrency'],
+                timeout=options['timeout'],
+                max_attempts=options['max_attempts'])
+            if verbosity > 1 and (fetched or failed):
+                print "Fetched %d covers, %d failed" % (fetched, failed)
+            if not (fetched or failed):
+                if options['once']:
+                    return
+                time.sleep(options['poll'])
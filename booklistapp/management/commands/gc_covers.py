@@ -0,0 +1,68 @@
+import os
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from infxbooklist.booklistapp.models import Book
+from settings import COVER_DIR
+
+# How many file names to check against the database per query.
+CHUNK_SIZE = 500
+
+
+class Command(NoArgsCommand):
+    help = "Delete cover files in COVER_DIR that no Book refers to."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--min-age', type='int', dest='min_age', default=3600,
+                    help="Leave files younger than this many seconds, which "
+                         "fetch_covers may not have linked to their Book yet."),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="Only report what would be deleted."),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        cutoff = time.time() - options['min_age']
+        deleted = 0
+        for names in self._chunks(cutoff):
+            referenced = set(Book.objects.filter(cover_image__in=names) \
+                                         .values_list('cover_image', flat=True))
+            for name in names:
+                if name in referenced:
+                    continue
+                if verbosity > 1 or options['dry_run']:
+                    print name
+                if not options['dry_run']:
+                    try:
+                        os.unlink(os.path.join(COVER_DIR, name))
+                    except OSError:
+                        continue
+                deleted += 1
+        if verbosity > 0:
+            print "%s %d unreferenced covers" % (
+                options['dry_run'] and "Found" or "Deleted", deleted)
+
+    def _chunks(self, cutoff):
+        """
+        Yield lists of at most CHUNK_SIZE cover paths (relative to
+        COVER_DIR) older than cutoff. The store is walked one shard
+        directory at a time, so only one directory's listing is held
+        in memory at once.
+        """
+        chunk = []
+        for dirpath, dirnames, filenames in os.walk(COVER_DIR):
+            dirnames.sort()
+            for fn in filenames:
+                if fn.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    if os.path.getmtime(path) > cutoff:
+                        continue
+                except OSError:
+                    continue
+                chunk.append(os.path.relpath(path, COVER_DIR))
+                if len(chunk) >= CHUNK_SIZE:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
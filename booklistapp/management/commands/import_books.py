@@ -0,0 +1,211 @@
+import csv
+import itertools
+import os
+import re
+import sys
+import tempfile
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.forms import ValidationError
+from django.utils import simplejson
+from infxbooklist.booklistapp.models import Book, Recommendation, User, clean_isbn
+from infxbooklist.booklistapp import covers, gbooks, utils
+import httpclient
+
+_isbn_re = re.compile(r'^(\d{9}[\dXx]|\d{13})$')
+
+
+class Command(BaseCommand):
+    help = ("Import books, recommended by --user, from a CSV or JSON-lines "
+            "file of ISBNs and Google Books ids. Interrupted imports pick up "
+            "where they left off.")
+    args = '<file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--user', dest='user',
+                    help="Username the recommendations are made by (required)."),
+        make_option('--format', dest='format', choices=('csv', 'jsonl'),
+                    help="csv or jsonl; by default, guessed from the file name."),
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help="Rows looked up and saved together, in one transaction."),
+        make_option('--workers', type='int', dest='workers',
+                    default=httpclient.MAX_PER_HOST,
+                    help="Simultaneous Google Books lookups."),
+        make_option('--checkpoint', dest='checkpoint',
+                    help="File recording progress; by default <file>.checkpoint."),
+        make_option('--restart', action='store_true', dest='restart', default=False,
+                    help="Ignore the checkpoint and start from the first row."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the one file to import.")
+        if not options['user']:
+            raise CommandError("--user is required.")
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError("No user %r." % options['user'])
+        path = args[0]
+        format = options['format'] or \
+                 (os.path.splitext(path)[1] in ('.jsonl', '.json') and 'jsonl' or 'csv')
+        checkpoint = options['checkpoint'] or path + '.checkpoint'
+        verbosity = int(options.get('verbosity', 1))
+
+        done = 0
+        if not options['restart'] and os.path.exists(checkpoint):
+            done = int(open(checkpoint).read().strip() or 0)
+            if verbosity > 0:
+                print "Resuming after line %d" % done
+
+        started = time.time()
+        imported = failed = 0
+        rows = (r for r in self._rows(open(path, 'rU'), format) if r[0] > done)
+        while True:
+            batch = list(itertools.islice(rows, options['batch_size']))
+            if not batch:
+                break
+            results = self._resolve_batch(batch, options['workers'])
+            for (row, value), error in zip(batch, self._save(user, results)):
+                if error is None:
+                    imported += 1
+                else:
+                    failed += 1
+                    print >>sys.stderr, "Line %d (%s): %s" % (row, value[1], error)
+            done = batch[-1][0]
+            self._write_checkpoint(checkpoint, done)
+            if verbosity > 0:
+                elapsed = time.time() - started
+                print "Line %d: %d imported, %d failed, %.1f rows/sec" % (
+                    done, imported, failed, (imported + failed) / max(elapsed, 0.001))
+        if os.path.exists(checkpoint):
+            os.unlink(checkpoint)
+        if verbosity > 0:
+            print "Imported %d books, %d failed, in %.1fs" % (
+                imported, failed, time.time() - started)
+
+    def _rows(self, f, format):
+        """
+        Yield (line number, value) for each data row of f, value being
+        a ('isbn', ...) or ('gid', ...) pair, or an ('invalid', reason)
+        one for a row that can't be read.
+        """
+        if format == 'jsonl':
+            for row, line in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    obj = simplejson.loads(line)
+                except ValueError, e:
+                    yield row + 1, ('invalid', str(e))
+                    continue
+                if isinstance(obj, dict):
+                    if obj.get('gid'):
+                        yield row + 1, ('gid', obj['gid'])
+                    elif obj.get('isbn'):
+                        yield row + 1, ('isbn', obj['isbn'])
+                    else:
+                        yield row + 1, ('invalid', "no gid or isbn")
+                else:
+                    yield row + 1, _guess(unicode(obj))
+        else:
+            reader = csv.reader(f)
+            header = None
+            for row, cells in enumerate(reader):
+                if row == 0:
+                    names = [c.strip().lower() for c in cells]
+                    if 'gid' in names or 'isbn' in names:
+                        header = names
+                        continue
+                if not [c for c in cells if c.strip()]:
+                    continue
+                if header:
+                    fields = dict(zip(header, [c.strip() for c in cells]))
+                    if fields.get('gid'):
+                        yield row + 1, ('gid', fields['gid'])
+                    elif fields.get('isbn'):
+                        yield row + 1, ('isbn', fields['isbn'])
+                    else:
+                        yield row + 1, ('invalid', "no gid or isbn")
+                else:
+                    yield row + 1, _guess(cells[0].strip())
+
+    def _resolve_batch(self, batch, workers):
+        """
+        Return a (gbooks.Book, None) or (None, exception) pair for each
+        row of batch, in order. Google Books ids are looked up together
+        with gbooks.get_many; ISBNs have to be searched for one by one.
+        """
+        gid_rows = [i for i, (row, (kind, value)) in enumerate(batch) if kind == 'gid']
+        other_rows = [i for i, (row, (kind, value)) in enumerate(batch) if kind != 'gid']
+        results = [None] * len(batch)
+        found = gbooks.get_many([batch[i][1][1] for i in gid_rows], workers)
+        for i, (gid, gb, error) in zip(gid_rows, found):
+            results[i] = (gb, error)
+        searched = utils.parallel_map(self._resolve, [batch[i] for i in other_rows], workers)
+        for i, result in zip(other_rows, searched):
+            results[i] = result
+        return results
+
+    def _resolve(self, item):
+        """Return the gbooks.Book an ISBN row names; raise if there isn't one."""
+        row, (kind, value) = item
+        if kind == 'invalid':
+            raise ValueError(value)
+        try:
+            isbn = clean_isbn(value)
+        except ValidationError, e:
+            raise ValueError('; '.join(e.messages))
+        found = gbooks.search('isbn:' + isbn)
+        if not found:
+            raise LookupError("No book with ISBN %s" % isbn)
+        return found[0]
+
+    def _save(self, user, results):
+        """
+        Save the Books and Recommendations of a batch of resolved rows
+        in one transaction, falling back to one transaction per row if
+        that fails. Returns an error, or None, for each row.
+        """
+        try:
+            self._save_all(user, [gb for gb, error in results if error is None])
+            return [error for gb, error in results]
+        except Exception:
+            errors = []
+            for gb, error in results:
+                if error is None:
+                    try:
+                        self._save_all(user, [gb])
+                    except Exception, e:
+                        error = e
+                errors.append(error)
+            return errors
+
+    @transaction.commit_on_success
+    def _save_all(self, user, found):
+        for gb in found:
+            # As views.edit does for a book added by hand.
+            b = Book.objects.get_or_create(gid=gb.gid)[0]
+            b.title = gb.title
+            b.authors = gb.authors
+            b.isbn = gb.isbn
+            b.save()
+            if gb.thumbnail_url and not b.cover_image:
+                covers.enqueue(b, gb.thumbnail_url)
+            Recommendation.objects.get_or_create(user=user, book=b)
+
+    def _write_checkpoint(self, checkpoint, done):
+        """Record that rows up to done are imported, atomically."""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(checkpoint)))
+        os.write(fd, '%d\n' % done)
+        os.close(fd)
+        os.rename(tmp, checkpoint)
+
+
+def _guess(value):
+    """Return ('isbn', value) if value looks like an ISBN, else ('gid', value)."""
+    if _isbn_re.match(value.replace('-', '').replace(' ', '')):
+        return 'isbn', value
+    return 'gid', value
@@ -0,0 +1,48 @@
+import time
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from infxbooklist.booklistapp.models import Book, Recommendation
+from infxbooklist.booklistapp import search
+
+# Books indexed per transaction.
+CHUNK_SIZE = 500
+
+
+class Command(NoArgsCommand):
+    help = "Rebuild the full-text search index from scratch."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        started = time.time()
+        index = search.get_index()
+        self._clear(index)
+        done = 0
+        last_id = 0
+        while True:
+            # Walk the table by id, so the whole of it is never in memory.
+            books = list(Book.objects.filter(id__gt=last_id).order_by('id')[:CHUNK_SIZE])
+            if not books:
+                break
+            self._index_chunk(index, books)
+            last_id = books[-1].id
+            done += len(books)
+            if verbosity > 1:
+                print "Indexed %d books" % done
+        if verbosity > 0:
+            print "Indexed %d books in %.1fs with %s" % (
+                done, time.time() - started, index.__class__.__name__)
+
+    @transaction.commit_on_success
+    def _clear(self, index):
+        index.clear()
+
+    @transaction.commit_on_success
+    def _index_chunk(self, index, books):
+        comments = dict((b.id, []) for b in books)
+        for book_id, comment in Recommendation.objects \
+                                              .filter(book__in=comments.keys()) \
+                                              .exclude(comment='') \
+                                              .values_list('book', 'comment'):
+            comments[book_id].append(comment)
+        for b in books:
+            index.add(b, comments[b.id])
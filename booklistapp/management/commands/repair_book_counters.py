@@ -0,0 +1,42 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from infxbooklist.booklistapp.models import Book, book_counters
+
+# Books updated per transaction.
+CHUNK_SIZE = 500
+
+
+class Command(NoArgsCommand):
+    help = "Recompute every Book's recommendation counters from its Recommendations."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help="Only report which books are wrong."),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        counters = book_counters()
+        wrong = []
+        for row in Book.objects.values_list('id', 'recommendation_count', 'comment_count',
+                                            'silent_count', 'last_recommended_at') \
+                               .iterator():
+            right = counters.get(row[0], (0, 0, 0, None))
+            if tuple(row[1:]) != right:
+                if verbosity > 1 or options['dry_run']:
+                    print "Book %d: %r should be %r" % (row[0], row[1:], right)
+                wrong.append((row[0], right))
+        if not options['dry_run']:
+            for i in range(0, len(wrong), CHUNK_SIZE):
+                self._update(wrong[i:i+CHUNK_SIZE])
+        if verbosity > 0:
+            print "%s %d of %d books" % (options['dry_run'] and "Found wrong" or "Repaired",
+                                         len(wrong), Book.objects.count())
+
+    @transaction.commit_on_success
+    def _update(self, wrong):
+        for book_id, (count, comments, silent, last) in wrong:
+            Book.objects.filter(pk=book_id).update(recommendation_count=count,
+                                                   comment_count=comments,
+                                                   silent_count=silent,
+                                                   last_recommended_at=last)
@@ -1,12 +1,25 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import F, signals
+from django.db.backends.util import typecast_timestamp
 from django.forms import ValidationError
 from django.contrib.auth.models import User
-from settings import AMAZON_KEY
+from settings import AMAZON_KEY, COVER_DIR, ECS_CACHE_PATH, ECS_CACHE_MAX_SIZE, \
+                     RATE_LIMIT_PATH, ECS_RATE_LIMIT, GBOOKS_RATE_LIMIT
 from utils import english_list
+from diskcache import DiskCache
+from ratelimit import RateLimiter
 import ecs
+import gbooks
 import urllib2
 import pyisbn
 import os
+import datetime
+import time
+
+if ECS_CACHE_PATH:
+    ecs.setCache(DiskCache(ECS_CACHE_PATH, ECS_CACHE_MAX_SIZE))
+ecs.setRateLimiter(RateLimiter(ECS_RATE_LIMIT, path=RATE_LIMIT_PATH))
+gbooks.limiter = RateLimiter(GBOOKS_RATE_LIMIT, GBOOKS_RATE_LIMIT, path=RATE_LIMIT_PATH)
 
 
 class ISBNField(models.CharField):
@@ -16,14 +29,18 @@ class ISBNField(models.CharField):
     def get_internal_type(self):
         return 'CharField'
     def clean(self, value):
-        value = super(ISBNField, self).clean(value)
-        value = ''.join(value.split('-'))
-        try:
-            if not pyisbn.validate(value):
-                raise ValidationError('Invalid ISBN')
-        except (TypeError, ValueError), e:
-            raise ValidationError, str(e)
-        return value
+        return clean_isbn(super(ISBNField, self).clean(value))
+
+
+def clean_isbn(value):
+    """Return value without dashes; raise ValidationError if not an ISBN."""
+    value = ''.join(value.split('-'))
+    try:
+        if not pyisbn.validate(value):
+            raise ValidationError('Invalid ISBN')
+    except (TypeError, ValueError), e:
+        raise ValidationError, str(e)
+    return value
 
 
 class Book(models.Model):
@@ -31,19 +48,35 @@ class Book(models.Model):
     isbn = ISBNField(null=True)
     title = models.CharField(max_length=200)
     authors = models.CharField(max_length=200)
-    cover_image = models.FilePathField(path="/opt/infxbooklist/bookcovers")
+    cover_image = models.FilePathField(path=COVER_DIR, recursive=True)
     added = models.DateTimeField(auto_now_add=True)
     edited = models.DateTimeField(auto_now=True)
+    # Counts of the Book's Recommendations, kept current by
+    # update_book_counters(); repair_book_counters recomputes them all.
+    # Not editable, so the admin leaves them alone.
+    recommendation_count = models.IntegerField(default=0, editable=False)
+    comment_count = models.IntegerField(default=0, editable=False)
+    silent_count = models.IntegerField(default=0, editable=False)
+    last_recommended_at = models.DateTimeField(null=True, blank=True, db_index=True,
+                                               editable=False)
     def __unicode__(self):
         return "\""+str(self.title)+"\" by "+str(self.authors)
     def url(self):
         return 'http://books.google.com/books?id='+self.gid
+    def _recommendations(self):
+        # load_recommendations() attaches a prefetched list; fall back
+        # to a query for Books that didn't come through it.
+        if not hasattr(self, '_recommendation_cache'):
+            self._recommendation_cache = list(self.recommendation_set \
+                                              .select_related('user') \
+                                              .order_by('added'))
+        return self._recommendation_cache
     def get_comments(self):
-        return [r for r in self.recommendation_set.all() if r.comment]
+        return [r for r in self._recommendations() if r.comment]
     def get_silent_recommendations(self):
-        return [r for r in self.recommendation_set.all() if not r.comment]
+        return [r for r in self._recommendations() if not r.comment]
     def get_all_recommendations(self):
-        return [r for r in self.recommendation_set.all()]
+        return list(self._recommendations())
 
    
 class Category(models.Model):
@@ -88,8 +121,181 @@ class Recommendation(models.Model):
             return u"<Blank recommendation by %s>" % unicode(self.user)
 
 
+class CoverFetch(models.Model):
+    """
+    A pending download of a Book's cover image. The fetch_covers
+    management command works through these; see covers.py.
+    """
+    book = models.ForeignKey(Book, unique=True)
+    url = models.CharField(max_length=500)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+    def __unicode__(self):
+        return u"Cover for %s (%d attempts)" % (self.book.gid, self.attempts)
+
+
+class SearchTerm(models.Model):
+    """
+    A word in a Book's searchable text, with how much it counts. This
+    is the portable inverted index used by search.TermIndex.
+    """
+    term = models.CharField(max_length=40, db_index=True)
+    book = models.ForeignKey(Book)
+    weight = models.FloatField()
+    def __unicode__(self):
+        return u"%s: %s" % (self.term, self.book_id)
+
+
+class CatalogueVersion(models.Model):
+    """
+    A single row whose counter goes up whenever a Book, Recommendation
+    or Category changes. Cached pages are keyed by it, so bumping it
+    invalidates them all in every process at once. Changes to a
+    Category's books send no signal, so whatever makes them must call
+    bump() itself, after they are saved.
+    """
+    counter = models.IntegerField(default=0)
+    changed = models.DateTimeField()
+    def __unicode__(self):
+        return u"Version %d of %s" % (self.counter, self.changed)
+    def timestamp(self):
+        """Return changed as seconds since the epoch."""
+        return time.mktime(self.changed.timetuple())
+    @classmethod
+    def current(cls):
+        try:
+            return cls.objects.get(pk=1)
+        except cls.DoesNotExist:
+            return cls.objects.get_or_create(pk=1,
+                defaults={'changed': datetime.datetime.now()})[0]
+    @classmethod
+    def bump(cls):
+        cls.current()
+        cls.objects.filter(pk=1).update(counter=F('counter') + 1,
+                                        changed=datetime.datetime.now())
+
+
+def _catalogue_changed(sender, **kwargs):
+    CatalogueVersion.bump()
+
+for model in (Book, Category, Recommendation):
+    signals.post_save.connect(_catalogue_changed, sender=model)
+    signals.post_delete.connect(_catalogue_changed, sender=model)
+
+
+def update_book_counters(book_id):
+    """
+    Recompute the recommendation counters of the Book with this id.
+    It's one UPDATE, so the counters can't be left half-written. By
+    the time post_save fires, save() has committed, so the UPDATE is
+    committed here unless a transaction is being managed.
+    """
+    qn = connection.ops.quote_name
+    def counted(aggregate, condition=''):
+        return 'SELECT %s FROM %s WHERE %s = %s.%s%s' % (
+            aggregate, qn(Recommendation._meta.db_table),
+            qn(Recommendation._meta.get_field('book').column),
+            qn(Book._meta.db_table), qn(Book._meta.pk.column), condition)
+    cursor = connection.cursor()
+    cursor.execute('UPDATE %s SET %s = (%s), %s = (%s), %s = (%s), %s = (%s) '
+                   'WHERE %s = %%s' % (
+                       qn(Book._meta.db_table),
+                       qn('recommendation_count'), counted('count(*)'),
+                       qn('comment_count'),
+                       counted('count(*)', " AND %s <> ''" % qn('comment')),
+                       qn('silent_count'),
+                       counted('count(*)', " AND %s = ''" % qn('comment')),
+                       qn('last_recommended_at'), counted('max(%s)' % qn('added')),
+                       qn(Book._meta.pk.column)),
+                   [book_id])
+    transaction.commit_unless_managed()
+
+def _recommendation_changed(sender, instance, **kwargs):
+    update_book_counters(instance.book_id)
+
+signals.post_save.connect(_recommendation_changed, sender=Recommendation)
+signals.post_delete.connect(_recommendation_changed, sender=Recommendation)
+
+def _book_saved(sender, instance, **kwargs):
+    # save() writes every column, counters included, from whenever the
+    # Book was read; recount in case a Recommendation changed since.
+    update_book_counters(instance.id)
+
+signals.post_save.connect(_book_saved, sender=Book)
+
+
+def book_counters():
+    """
+    Return {book id: (recommendations, comments, silent, last
+    recommended)} for every Book with a Recommendation, from one
+    aggregate query.
+    """
+    qn = connection.ops.quote_name
+    book_column = qn(Recommendation._meta.get_field('book').column)
+    cursor = connection.cursor()
+    cursor.execute("SELECT %s, count(*), sum(CASE WHEN %s <> '' THEN 1 ELSE 0 END), "
+                   "max(%s) FROM %s GROUP BY %s" % (
+                       book_column, qn('comment'), qn('added'),
+                       qn(Recommendation._meta.db_table), book_column))
+    counters = {}
+    for book_id, count, comments, last in cursor.fetchall():
+        if isinstance(last, basestring):
+            last = typecast_timestamp(last)
+        counters[book_id] = (count, comments, count - comments, last)
+    return counters
+
+
+def load_recommendations(books):
+    """
+    Evaluate books and attach every Recommendation (with its User) to
+    them using a single query, so that the get_*recommendations helpers
+    partition an in-memory list instead of hitting the database once
+    per book. Returns the books as a list.
+    """
+    books = list(books)
+    by_id = {}
+    for b in books:
+        b._recommendation_cache = []
+        by_id[b.id] = b
+    if by_id:
+        recs = Recommendation.objects.filter(book__in=by_id.keys()) \
+                                     .select_related('user') \
+                                     .order_by('added')
+        for r in recs:
+            b = by_id[r.book_id]
+            # Save r.book from looking up the Book we already have.
+            r._book_cache = b
+            b._recommendation_cache.append(r)
+    return books
+
+
+def book_category_pairs(user):
+    """
+    Return a set of (book id, category id) pairs, one for each category
+    membership of a book the given User recommends. Uses one query.
+    """
+    field = Category._meta.get_field('books')
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('SELECT m.%s, m.%s FROM %s m INNER JOIN %s r ON r.%s = m.%s '
+                   'WHERE r.%s = %%s' % (
+                       qn(field.m2m_reverse_name()), qn(field.m2m_column_name()),
+                       qn(field.m2m_db_table()), qn(Recommendation._meta.db_table),
+                       qn(Recommendation._meta.get_field('book').column),
+                       qn(field.m2m_reverse_name()),
+                       qn(Recommendation._meta.get_field('user').column)),
+                   [user.id])
+    return set(cursor.fetchall())
+
+
 class FeedbackNote(models.Model):
     """A note left by a user."""
     text = models.TextField()
     def __unicode__(self):
         return self.text[:100]
+
+
+# Keeps the full-text index current; needs the models above.
+import search
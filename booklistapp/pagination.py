@@ -0,0 +1,75 @@
+"""
+Keyset ("seek") pagination for book listings.
+
+Instead of OFFSET paging, which scans and throws away every row before
+the page, a page is found by seeking to the (edited, id) position of
+the last book on the page before it. That costs the same however deep
+the page is, given the (edited, id) index in sql/book.sql.
+
+Positions travel in URLs as opaque cursors (see encode_cursor()).
+"""
+import base64
+import datetime
+from django.db.models import Q
+
+PER_PAGE = 10
+
+
+def encode_cursor(book):
+    """Return an opaque, URL-safe cursor for the position of book."""
+    raw = '%s.%06d|%d' % (book.edited.strftime('%Y-%m-%d %H:%M:%S'),
+                          book.edited.microsecond, book.id)
+    return base64.urlsafe_b64encode(raw).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (edited, id) position of cursor. Raise ValueError if bad."""
+    try:
+        cursor = str(cursor)
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        stamp, id = raw.rsplit('|', 1)
+        seconds, micro = stamp.split('.')
+        edited = datetime.datetime.strptime(seconds, '%Y-%m-%d %H:%M:%S')
+        return edited.replace(microsecond=int(micro)), int(id)
+    except (TypeError, UnicodeError):
+        raise ValueError("Malformed cursor %r" % cursor)
+
+
+class CursorPage(object):
+    """
+    A page of books, newest edit first, seeking from a cursor.
+
+    With after, the page holds the books just older than it; with
+    before, the books just newer; with neither, the newest books.
+    Raises ValueError for a malformed cursor.
+    """
+    def __init__(self, queryset, after=None, before=None, per_page=PER_PAGE):
+        if before:
+            edited, id = decode_cursor(before)
+            rows = list(queryset.filter(Q(edited__gt=edited) |
+                                        Q(edited=edited, id__gt=id))
+                                .order_by('edited', 'id')[:per_page + 1])
+            if len(rows) > per_page:
+                rows.reverse()
+                self.object_list = rows[1:]
+                self.has_previous = True
+                self.has_next = True
+                return
+            # Fewer than a page of newer books: that is the first page.
+            after = None
+        if after:
+            edited, id = decode_cursor(after)
+            queryset = queryset.filter(Q(edited__lt=edited) |
+                                       Q(edited=edited, id__lt=id))
+        rows = list(queryset.order_by('-edited', '-id')[:per_page + 1])
+        self.object_list = rows[:per_page]
+        self.has_next = len(rows) > per_page
+        self.has_previous = bool(after)
+
+    def next_cursor(self):
+        if self.has_next:
+            return encode_cursor(self.object_list[-1])
+
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return encode_cursor(self.object_list[0])
@@ -0,0 +1,200 @@
+"""
+Full-text search over the local catalogue.
+
+Each Book is indexed as one document made of its title, authors, ISBN
+and the comments of its recommendations. Two index backends share one
+interface:
+
+    FTS5Index   an SQLite FTS5 virtual table, ranked with bm25(), used
+                when DATABASE_ENGINE is sqlite3 and FTS5 is available.
+    TermIndex   a plain inverted index in the SearchTerm table, which
+                works on any database.
+
+SEARCH_BACKEND in settings picks one ('fts5' or 'terms'); 'auto'
+prefers FTS5. The index is kept current by signal handlers on Book and
+Recommendation, and rebuild_search_index rebuilds it in bulk.
+"""
+import re
+from django.db import connection, transaction
+from django.db.models import Count, Sum, signals
+from settings import DATABASE_ENGINE, SEARCH_BACKEND
+from models import Book, Recommendation, SearchTerm
+
+# Relative weight of a match in each part of the document.
+WEIGHTS = (('title', 10.0), ('authors', 5.0), ('isbn', 10.0), ('comments', 1.0))
+MAX_TERM_LENGTH = SearchTerm._meta.get_field('term').max_length
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the lower-cased words of text, as the index stores them."""
+    return [w[:MAX_TERM_LENGTH] for w in _word_re.findall((text or u'').lower())]
+
+
+def document(book, comments):
+    """Return the searchable fields of book as a dict."""
+    return {'title': book.title, 'authors': book.authors,
+            'isbn': book.isbn or u'', 'comments': u'\n'.join(comments)}
+
+
+class TermIndex(object):
+    """Inverted index of (term, book, weight) rows in the SearchTerm table."""
+
+    def add(self, book, comments):
+        self.remove(book.id)
+        weights = {}
+        fields = document(book, comments)
+        for field, weight in WEIGHTS:
+            for term in tokenize(fields[field]):
+                weights[term] = weights.get(term, 0) + weight
+        for term, weight in weights.items():
+            SearchTerm(term=term, book_id=book.id, weight=weight).save()
+
+    def remove(self, book_id):
+        SearchTerm.objects.filter(book=book_id).delete()
+
+    def clear(self):
+        SearchTerm.objects.all().delete()
+
+    def _matches(self, terms):
+        # Books having every term, best total weight first.
+        return SearchTerm.objects.filter(term__in=terms) \
+                                 .values('book') \
+                                 .annotate(score=Sum('weight'), matched=Count('term')) \
+                                 .filter(matched=len(set(terms)))
+
+    def count(self, terms):
+        return self._matches(terms).count()
+
+    def search(self, terms, offset, limit):
+        rows = self._matches(terms).order_by('-score', 'book')[offset:offset+limit]
+        return [row['book'] for row in rows]
+
+
+class FTS5Index(object):
+    """
+    An SQLite FTS5 table whose rowids are Book ids. Writes are raw SQL,
+    made from signal handlers after save() has committed, so each one
+    commits itself unless a transaction is being managed.
+    """
+    TABLE = 'booklistapp_book_fts'
+
+    def __init__(self):
+        cursor = connection.cursor()
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s)' %
+                       (self.TABLE, ', '.join(f for f, w in WEIGHTS)))
+
+    def add(self, book, comments):
+        fields = document(book, comments)
+        cursor = connection.cursor()
+        cursor.execute('INSERT OR REPLACE INTO %s (rowid, %s) VALUES (%%s, %s)' %
+                       (self.TABLE, ', '.join(f for f, w in WEIGHTS),
+                        ', '.join(['%s'] * len(WEIGHTS))),
+                       [book.id] + [fields[f] for f, w in WEIGHTS])
+        transaction.commit_unless_managed()
+
+    def remove(self, book_id):
+        connection.cursor().execute('DELETE FROM %s WHERE rowid = %%s' % self.TABLE,
+                                    [book_id])
+        transaction.commit_unless_managed()
+
+    def clear(self):
+        connection.cursor().execute('DELETE FROM %s' % self.TABLE)
+        transaction.commit_unless_managed()
+
+    def _match(self, terms):
+        # Quote every term, so user input can't use FTS query syntax.
+        return ' '.join('"%s"' % t for t in terms)
+
+    def count(self, terms):
+        cursor = connection.cursor()
+        cursor.execute('SELECT count(*) FROM %s WHERE %s MATCH %%s' %
+                       (self.TABLE, self.TABLE), [self._match(terms)])
+        return cursor.fetchone()[0]
+
+    def search(self, terms, offset, limit):
+        cursor = connection.cursor()
+        cursor.execute('SELECT rowid FROM %s WHERE %s MATCH %%s '
+                       'ORDER BY bm25(%s, %s) LIMIT %%s OFFSET %%s' %
+                       (self.TABLE, self.TABLE, self.TABLE,
+                        ', '.join(str(w) for f, w in WEIGHTS)),
+                       [self._match(terms), limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+_index = None
+
+def get_index():
+    """Return the configured index backend."""
+    global _index
+    if _index is None:
+        if SEARCH_BACKEND in ('auto', 'fts5') and DATABASE_ENGINE == 'sqlite3':
+            try:
+                _index = FTS5Index()
+            except Exception:
+                if SEARCH_BACKEND == 'fts5':
+                    raise
+        if _index is None:
+            _index = TermIndex()
+    return _index
+
+
+class SearchResults(object):
+    """
+    Books matching a query, best match first. Sliceable and countable
+    like a QuerySet, so it can be handed to a Paginator; only the
+    slice asked for is fetched.
+    """
+    def __init__(self, query):
+        self.terms = tokenize(query)
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.terms and get_index().count(self.terms) or 0
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            return self[k:k+1][0]
+        offset = k.start or 0
+        if not self.terms:
+            return []
+        limit = self.count() - offset if k.stop is None else k.stop - offset
+        if limit <= 0:
+            return []
+        ids = get_index().search(self.terms, offset, limit)
+        books = Book.objects.in_bulk(ids)
+        return [books[id] for id in ids if id in books]
+
+
+def index_book(book_id):
+    """(Re)index the Book with this id, or drop it if it's gone."""
+    try:
+        book = Book.objects.get(pk=book_id)
+    except Book.DoesNotExist:
+        get_index().remove(book_id)
+        return
+    comments = Recommendation.objects.filter(book=book) \
+                                     .exclude(comment='') \
+                                     .values_list('comment', flat=True)
+    get_index().add(book, comments)
+
+
+def _book_saved(sender, instance, **kwargs):
+    index_book(instance.id)
+
+def _book_deleted(sender, instance, **kwargs):
+    get_index().remove(instance.id)
+
+def _recommendation_changed(sender, instance, **kwargs):
+    index_book(instance.book_id)
+
+signals.post_save.connect(_book_saved, sender=Book)
+signals.post_delete.connect(_book_deleted, sender=Book)
+signals.post_save.connect(_recommendation_changed, sender=Recommendation)
+signals.post_delete.connect(_recommendation_changed, sender=Recommendation)
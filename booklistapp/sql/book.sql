@@ -0,0 +1,7 @@
+-- Backs the keyset pagination in pagination.py, which seeks on and
+-- orders by (edited, id).
+CREATE INDEX booklistapp_book_edited_id ON booklistapp_book (edited, id);
+
+-- Backs the "most recommended" listing (views.popular), which orders
+-- by (recommendation_count, last_recommended_at, id), all descending.
+CREATE INDEX booklistapp_book_popular ON booklistapp_book (recommendation_count, last_recommended_at, id);
@@ -46,4 +46,25 @@ def paginator(context, adjacent_pages=2):
         'show_first': 1 not in page_numbers,
         'show_last': context['pages'] not in page_numbers,
         'path': path,
-    }
\ No newline at end of file
+    }
+
+
+@register.inclusion_tag('booklistapp/cursor_paginator.html', takes_context=True)
+def cursor_paginator(context):
+    """
+    To be used with the cursor (keyset) pagination in views.index.
+
+    Renders Newer/Older links carrying the opaque cursors for the pages
+    either side of this one, plus the total number of books if known.
+    Deep pages cost the same as the first, so there are no page numbers.
+    Links keep the cursor_query (say, a ?c= category filter) if given.
+
+    """
+    return {
+        'query': context.get('cursor_query', ''),
+        'hits': context.get('hits'),
+        'has_next': context['has_next'],
+        'has_previous': context['has_previous'],
+        'next_cursor': context['next_cursor'],
+        'previous_cursor': context['previous_cursor'],
+    }
@@ -0,0 +1,196 @@
+import BaseHTTPServer
+import SocketServer
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+from models import Book, CatalogueVersion, Category, CategoryType, CoverFetch, Recommendation, User
+import categoryindex
+import covers
+
+# Queries for a complete-view index page: the catalogue version, the
+# category types, the page of books, their count and their
+# recommendations (with users).
+INDEX_QUERIES = 5
+
+
+class QueryCountTest(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create_user('user%d' % n, 'user%d@uci.edu' % n)
+                      for n in range(10)]
+        self.books = []
+        for n in range(5):
+            b = Book(gid='gid%d' % n, title='Book %d' % n, authors='Author %d' % n)
+            b.save()
+            self.books.append(b)
+        self.recommend(1)
+
+    def recommend(self, per_book):
+        for b in self.books:
+            for u in self.users[:per_book]:
+                Recommendation.objects.get_or_create(user=u, book=b,
+                    defaults={'comment': u.username == 'user0' and 'Good.' or ''})
+
+    def queries(self, path):
+        """Return how many queries a GET of path takes."""
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            return len(connection.queries)
+        finally:
+            settings.DEBUG = debug
+
+    def test_index_queries_dont_grow_with_recommendations(self):
+        few = self.queries('/')
+        self.recommend(10)
+        many = self.queries('/')
+        self.assertEqual(few, INDEX_QUERIES)
+        self.assertEqual(many, INDEX_QUERIES)
+
+
+
+
+class BookCountersTest(TestCase):
+
+    def test_saving_stale_book_keeps_counters(self):
+        user = User.objects.create_user('tester', 'tester@uci.edu')
+        stale = Book.objects.create(gid='gid0', title='Book', authors='Author')
+        Recommendation.objects.create(user=user, book=stale, comment='Good.')
+        stale.title = 'Retitled'
+        stale.save()
+        b = Book.objects.get(pk=stale.pk)
+        self.assertEqual((b.recommendation_count, b.comment_count, b.silent_count),
+                         (1, 1, 0))
+        self.assertTrue(b.last_recommended_at is not None)
+
+
+class CategoryIndexTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('tester', 'tester@uci.edu', 'secret')
+        self.client.login(username='tester', password='secret')
+        ct = CategoryType.objects.create(description='Subject')
+        Category.objects.create(name='Programming', slug='programming',
+                                category_type=ct)
+        self.book = Book.objects.create(gid='gid0', title='Book', authors='Author')
+        Recommendation.objects.create(user=user, book=self.book)
+
+    def test_edit_updates_index_in_place(self):
+        index = categoryindex.get_index(CatalogueVersion.current().counter)
+        self.assertEqual(index.count(index.filter(['programming'])), 0)
+        self.client.post('/edit/', {'gid': 'gid0', 'action': 'update',
+                                    'blurb': 'Good.', 'programming': 'on'})
+        self.assertTrue(categoryindex._index is index)
+        self.assertEqual(index.counter, CatalogueVersion.current().counter)
+        self.assertEqual(index.count(index.filter(['programming'])), 1)
+
+
+class CoverHost(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local stand-in for a cover host: /cover.jpg is an image, /slow
+    is one that takes two seconds, and /error is a 500.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), CoverHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        pass    # Clients that time out leave broken pipes behind.
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+
+class CoverHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    IMAGE = 'GIF89a cover'
+
+    def do_GET(self):
+        if self.path == '/error':
+            self.send_error(500)
+            return
+        if self.path == '/slow':
+            time.sleep(2)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/gif')
+        self.end_headers()
+        self.wfile.write(self.IMAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchCoversTest(TestCase):
+
+    def setUp(self):
+        self.host = CoverHost()
+        self.cover_dir = tempfile.mkdtemp()
+        self._cover_dir, covers.COVER_DIR = covers.COVER_DIR, self.cover_dir
+
+    def tearDown(self):
+        covers.COVER_DIR = self._cover_dir
+        shutil.rmtree(self.cover_dir)
+        self.host.shutdown()
+        self.host.server_close()
+
+    def queue(self, path):
+        b = Book(gid=path.strip('/') + str(Book.objects.count()),
+                 title='Book', authors='Author')
+        b.save()
+        return covers.enqueue(b, self.host.url(path))
+
+    def test_fetches_cover(self):
+        job = self.queue('/cover.jpg')
+        self.assertEqual(covers.run_once(), (1, 0))
+        name = Book.objects.get(pk=job.book_id).cover_image
+        self.assertEqual(open(os.path.join(self.cover_dir, name), 'rb').read(),
+                         CoverHandler.IMAGE)
+        self.assertEqual(CoverFetch.objects.count(), 0)
+
+    def test_store_touches_existing_cover(self):
+        name = covers.store(CoverHandler.IMAGE)
+        path = os.path.join(self.cover_dir, name)
+        os.utime(path, (0, 0))
+        self.assertEqual(covers.store(CoverHandler.IMAGE), name)
+        self.assertTrue(os.path.getmtime(path) > time.time() - 60)
+
+    def test_failing_host_is_retried_later(self):
+        job = self.queue('/error')
+        self.assertEqual(covers.run_once(), (0, 1))
+        job = CoverFetch.objects.get(pk=job.pk)
+        self.assertEqual(job.attempts, 1)
+        self.assertFalse(job.failed)
+        self.assertTrue(job.next_attempt > datetime.datetime.now())
+        self.assertEqual(Book.objects.get(pk=job.book_id).cover_image, '')
+        # Not due yet, so not tried again.
+        self.assertEqual(covers.run_once(), (0, 0))
+
+    def test_gives_up_after_max_attempts(self):
+        job = self.queue('/error')
+        for n in range(3):
+            CoverFetch.objects.filter(pk=job.pk).update(
+                next_attempt=datetime.datetime.now())
+            covers.run_once(max_attempts=3)
+        job = CoverFetch.objects.get(pk=job.pk)
+        self.assertEqual(job.attempts, 3)
+        self.assertTrue(job.failed)
+
+    def test_slow_hosts_time_out_concurrently(self):
+        for n in range(4):
+            self.queue('/slow')
+        self.queue('/cover.jpg')
+        started = time.time()
+        self.assertEqual(covers.run_once(concurrency=5, timeout=0.5), (1, 4))
+        # Each slow host cost one timeout, and they ran side by side.
+        self.assertTrue(time.time() - started < 1.5)
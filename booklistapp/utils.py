@@ -1,3 +1,8 @@
+import Queue
+import threading
+import time
+
+
 def english_list(l,the_and="&"):
     if isinstance(l, type("")) or isinstance(l, type(u'')):
         return l
@@ -7,3 +12,112 @@ def english_list(l,the_and="&"):
         return l[0]
     else:
         return ', '.join(l[:-1])+' '+the_and+' '+l[-1]
+
+
+def parallel_map(func, items, workers=4):
+    """
+    Call func on each of items from at most `workers` threads.
+    Returns a list, in the same order as items, holding a
+    (result, None) pair for each call that returned and a
+    (None, exception) pair for each call that raised, so one
+    failure doesn't abort the rest.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for i, item in enumerate(items):
+        pending.put((i, item))
+    def work():
+        while True:
+            try:
+                i, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (func(item), None)
+            except Exception, e:
+                results[i] = (None, e)
+    threads = [threading.Thread(target=work)
+               for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class LRUCache(object):
+    """
+    A thread-safe in-memory cache holding at most max_size entries,
+    each of which expires ttl seconds after it was set. When full,
+    the least recently used entry is evicted. Counts hits and misses.
+    """
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        # Entries are [prev, next, key, value, expires] links in a
+        # circular list, most recently used first after the root.
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _push_front(self, link):
+        root = self._root
+        link[0], link[1] = root, root[1]
+        root[1][0] = link
+        root[1] = link
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None and link[4] is not None and link[4] < time.time():
+                self._unlink(link)
+                del self._map[key]
+                link = None
+            if link is None:
+                self.misses += 1
+                return default
+            self._unlink(link)
+            self._push_front(link)
+            self.hits += 1
+            return link[3]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = ttl is not None and time.time() + ttl or None
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+            elif len(self._map) >= self.max_size:
+                oldest = self._root[0]
+                self._unlink(oldest)
+                del self._map[oldest[2]]
+            link = [None, None, key, value, expires]
+            self._push_front(link)
+            self._map[key] = link
+
+    def delete(self, key):
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def __len__(self):
+        return len(self._map)
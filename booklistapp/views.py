@@ -1,21 +1,32 @@
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified
 from django.shortcuts import render_to_response, get_object_or_404
-from django.core.paginator import Paginator
+from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+from django.core.paginator import Paginator, InvalidPage
 from django.contrib.auth.views import redirect_to_login
-from django.views.generic.list_detail import object_list
-from models import Book, Category, CategoryType, FeedbackNote, Recommendation, User
-from settings import AMAZON_KEY, DEBUG
+from models import Book, CatalogueVersion, Category, CategoryType, FeedbackNote, Recommendation, User
+from models import book_category_pairs, load_recommendations
+from pagination import CursorPage
+from search import SearchResults
+from settings import AMAZON_KEY, DEBUG, PAGE_CACHE_TIMEOUT
 from booklistapp.utils import english_list
 import urllib
-import urllib2
 import ecs
-import random
-import os
 import sys
-import datetime
+import categoryindex
+import covers
+import export
 import gbooks
 
 
+# Books in each Atom feed.
+FEED_SIZE = 25
+
+
 class StringChunker:
     '''
     A dirty trick. This wraps a str
@@ -42,24 +53,160 @@ def index(request, category):
             view = request.session['view']
     else:
         view = 'complete'
+    if category and category[-1] == '/':
+        category = category[:-1]
+    # Pages are found by cursor (see pagination.py) unless an
+    # old-style ?page=N is asked for.
+    if 'page' in request.GET:
+        position = 'page=' + request.GET['page']
+    elif 'before' in request.GET:
+        position = 'before=' + request.GET['before']
+    else:
+        position = 'after=' + request.GET.get('after', '')
+    # ?c=slug+slug filters by several categories; see categoryindex.py.
+    categories = ' '.join(sorted(request.GET.get('c', '').split()))
+    return _versioned_response(request, 'index', (view, position, category or '', categories),
+                               lambda version: _render_index(request, category, view, version))
+
+
+def _versioned_response(request, name, variant, render, mimetype=None):
+    """
+    Return render(version)'s output, cached under the catalogue version,
+    which goes up on every write, so stale copies are simply never
+    looked up again. The same key doubles as the ETag, so a client with
+    a current copy gets a 304 after nothing but the version is read.
+    """
+    version = CatalogueVersion.current()
+    key = md5_constructor((u'%d:%s' % (version.counter, u':'.join(variant))) \
+                          .encode('utf-8')).hexdigest()
+    etag = '"%s"' % key
+    if _not_modified(request, etag, version.timestamp()):
+        return HttpResponseNotModified()
+    content = cache.get(name + ':' + key)
+    if content is None:
+        content = render(version)
+        cache.set(name + ':' + key, content, PAGE_CACHE_TIMEOUT)
+    response = HttpResponse(content, mimetype=mimetype)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(version.timestamp())
+    return response
+
+
+def _not_modified(request, etag, last_modified):
+    """
+    Return whether the client's copy, as described by its
+    If-None-Match or If-Modified-Since header, is still current.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return if_none_match.strip() == '*' or \
+               etag in [t.strip() for t in if_none_match.split(',')]
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        return not was_modified_since(if_modified_since, last_modified)
+    return False
+
+
+def _render_index(request, category, view, version):
     # What books to display
     if category:
-        if category[-1] == '/':
-            category = category[:-1]
         category_s = get_object_or_404(Category, slug=category)
-        books_to_display = category_s.books.all().order_by('-edited')
+        books_to_display = category_s.books.all()
         page_title = category_s.name
     else:
-        books_to_display = Book.objects.all().order_by('-edited')
+        books_to_display = Book.objects.all()
         page_title = ''
-    # Finish and render
-    return object_list(request, queryset=books_to_display,
-                       template_object_name='book',
-                       paginate_by=10,
-                       extra_context={'page_title': page_title,
-                                      'complete_view': view=='complete',
-                                      'category_types': CategoryType.objects.all(),
-                                      'current_slug': category})
+    context = {'page_title': page_title,
+               'complete_view': view=='complete',
+               'category_types': CategoryType.objects.all(),
+               'current_slug': category}
+    slugs = request.GET.get('c', '').split()
+    if slugs:
+        book_list = _filter_by_categories(request, category, slugs, version, context)
+    elif 'page' in request.GET:
+        book_list = _paginate_by_number(request, books_to_display, context)
+    else:
+        try:
+            page_obj = CursorPage(books_to_display,
+                                  after=request.GET.get('after'),
+                                  before=request.GET.get('before'))
+        except ValueError:
+            raise Http404
+        book_list = page_obj.object_list
+        # Counting is the one query whose cost grows with the list,
+        # so it is done once per catalogue version, not per page.
+        count_key = 'count:%d:%s' % (version.counter, category or '')
+        hits = cache.get(count_key)
+        if hits is None:
+            hits = books_to_display.count()
+            cache.set(count_key, hits, PAGE_CACHE_TIMEOUT)
+        context.update({'cursor_pagination': True,
+                        'has_next': page_obj.has_next,
+                        'has_previous': page_obj.has_previous,
+                        'next_cursor': page_obj.next_cursor(),
+                        'previous_cursor': page_obj.previous_cursor(),
+                        'hits': hits})
+    if view == 'complete':
+        book_list = load_recommendations(book_list)
+    context['book_list'] = book_list
+    return render_to_string('booklistapp/book_list.html', context,
+                            context_instance=RequestContext(request))
+
+
+def _filter_by_categories(request, category, slugs, version, context):
+    """
+    Add the cursor pagination context for the books in categories
+    slugs (and category, if given), and return that page of books.
+    Pages are found from the bitmap index, so ?page=N isn't offered.
+    """
+    if category:
+        slugs = [category] + slugs
+    index = categoryindex.get_index(version.counter)
+    try:
+        bits = index.filter(slugs)
+        page_obj = index.page(bits, after=request.GET.get('after'),
+                              before=request.GET.get('before'))
+    except (KeyError, ValueError):
+        raise Http404
+    context.update({'page_title': english_list(index.names(slugs)),
+                    'cursor_pagination': True,
+                    'cursor_query': urllib.urlencode({'c': ' '.join(slugs)}) + '&',
+                    'has_next': page_obj.has_next,
+                    'has_previous': page_obj.has_previous,
+                    'next_cursor': page_obj.next_cursor(),
+                    'previous_cursor': page_obj.previous_cursor(),
+                    'hits': index.count(bits)})
+    return page_obj.object_list
+
+
+def _paginate_by_number(request, books_to_display, context):
+    """
+    Add the context variables the object_list generic view would for
+    ?page=N, and return that page of books.
+    """
+    paginator = Paginator(books_to_display.order_by('-edited', '-id'), 10)
+    page = request.GET['page']
+    try:
+        if page == 'last':
+            page = paginator.num_pages
+        page_obj = paginator.page(int(page))
+    except (ValueError, InvalidPage):
+        raise Http404
+    context.update({'paginator': paginator,
+                    'page_obj': page_obj,
+                    'is_paginated': page_obj.has_other_pages(),
+                    'results_per_page': paginator.per_page,
+                    'has_next': page_obj.has_next(),
+                    'has_previous': page_obj.has_previous(),
+                    'page': page_obj.number,
+                    'next': page_obj.next_page_number(),
+                    'previous': page_obj.previous_page_number(),
+                    'first_on_page': page_obj.start_index(),
+                    'last_on_page': page_obj.end_index(),
+                    'pages': paginator.num_pages,
+                    'hits': paginator.count,
+                    'page_range': paginator.page_range})
+    return list(page_obj.object_list)
     
     
 def edit(request):
@@ -69,28 +216,7 @@ def edit(request):
     if not (request.user.is_authenticated()):
         return redirect_to_login(request.get_full_path())
 
-    recs = Recommendation.objects.filter(user=request.user)
-    category_types = CategoryType.objects.all()
-    all_categories = Category.objects.all()
-    context = {'recs': recs,
-               'category_types': category_types,
-               'cat_check_htmls': []}
-    books_in_c = {}
-    for c in all_categories:
-        books_in_c[c] = [r for r in recs.filter(book__category=c) \
-                                        .distinct()]
-    print >>sys.stderr, repr(books_in_c)
-    for rec in recs:
-	    b = ''
-	    for ct in category_types:
-	        b += '<p style="font-weight: bold">%s</p>' % ct.description
-	        for c in ct.get_categories():
-	            b += '<input type="checkbox" name="{0}" id="{1}{0}"'.format(c.slug, rec.id)
-	            if rec in books_in_c[c]:
-	                b += 'checked="checked" '
-	            b += '/><label for="%d%s">%s</label><br />' % (rec.id, c.slug, c.name)
-	    context['cat_check_htmls'].append(b)
-             
+    context = {}
     if 'keywords' in request.GET:
         context['results'] = gbooks.search(request.GET['keywords'])
     elif 'gid' in request.POST:
@@ -99,18 +225,32 @@ def edit(request):
             r = Recommendation.objects.get(user=request.user,
                                            book=b)
             if request.POST['action'] == 'update':
+                before = CatalogueVersion.current().counter
+                r.comment = request.POST['blurb']
+                r.save()
+                chosen = set()
                 for c in Category.objects.all():
                     if c.slug in request.POST:
                         c.books.add(b)
+                        chosen.add(c.id)
                     else:
                         c.books.remove(b)
-                r.comment = request.POST['blurb']
-                r.save()
+                # add() and remove() send no signals, so the version
+                # has to be bumped by hand.
+                CatalogueVersion.bump()
+                # Saves this process rebuilding its category index. The
+                # version went up twice: once for r.save(), once above.
+                categoryindex.book_changed(b.id, chosen, before,
+                                           CatalogueVersion.current().counter,
+                                           bumps=2)
                 print >>sys.stderr, repr(request.POST)
             elif request.POST['action'] == 'delete':
-                if len(Recommendation.objects.filter(book=r.book)) == 1:
-                    os.unlink(os.path.join('/opt/infxbooklist/bookcovers/', r.book.cover_image))
-                    r.book.delete()
+                # The last recommendation takes the book with it. Count
+                # the rows themselves rather than trust recommendation_count.
+                if Recommendation.objects.filter(book=b).count() <= 1:
+                    cover_image = b.cover_image
+                    b.delete()
+                    covers.release(cover_image)
                 r.delete()
         else:
             # Make the book if doesn't exist, update if does
@@ -119,33 +259,109 @@ def edit(request):
             b.title = gb.title
             b.authors = gb.authors
             b.isbn = gb.isbn
-            try:
-                # Download the thumbnail image from Google
-                req = urllib2.Request(gb.thumbnail_url)
-                req.add_header("User-Agent", "Mozilla")
-                try:
-                    # TODO: These images are never deleted. Write a cron script to
-                    #       scrub the dir of images that tables no longer reference.
-                    image_link = urllib2.urlopen(req)
-                    img_data = image_link.read()
-                    image_link.close()
-                    rand_fn = datetime.datetime.utcnow().isoformat()+'__'+str(random.randint(0, sys.maxint))
-                    rand_pth = os.path.join('/opt/infxbooklist/bookcovers', rand_fn)
-                    with open(rand_pth, 'w') as f:
-                        f.write(img_data)
-                    b.cover_image = rand_fn
-                except Exception, e:
-                    print >>sys.stderr, "Tried to save thumbnail, but got exception:", repr(e)
-            finally:
-                b.save()
+            b.save()
+            # The cover is downloaded in the background by fetch_covers;
+            # until then the list shows a placeholder.
+            if gb.thumbnail_url and not b.cover_image:
+                covers.enqueue(b, gb.thumbnail_url)
             # Create a Recommendation, which links User and Book
             Recommendation(user=request.user, book=b).save()
         # Redirect to avoid refresh issues
         return HttpResponseRedirect("/edit/")
+
+    # List the user's recommendations, each with a checkbox per category
+    # saying whether its book is in that category. This costs three
+    # queries however many recommendations and categories there are.
+    recs = list(Recommendation.objects.filter(user=request.user) \
+                                      .select_related('book'))
+    category_tree = _category_tree()
+    memberships = book_category_pairs(request.user)
+    for rec in recs:
+        rec.category_choices = [
+            (ct, [(c, (rec.book_id, c.id) in memberships) for c in cats])
+            for ct, cats in category_tree]
+    context['recs'] = recs
     # Go.
     return render_to_response('edit.html', context)
+
+
+def _category_tree():
+    """
+    Return [(CategoryType, [Category, ...]), ...] from a single query,
+    in the same order as CategoryType.objects.all() and
+    CategoryType.get_categories() would give.
+    """
+    tree = []
+    for c in Category.objects.select_related('category_type') \
+                             .order_by('category_type', 'id'):
+        if not tree or tree[-1][0].id != c.category_type_id:
+            tree.append((c.category_type, []))
+        tree[-1][1].append(c)
+    return tree
     
     
+def search(request):
+    query = request.GET.get('q', '').strip()
+    paginator = Paginator(SearchResults(query), 10)
+    try:
+        page_obj = paginator.page(int(request.GET.get('page', 1)))
+    except (ValueError, InvalidPage):
+        raise Http404
+    context = {'query': query,
+               'book_list': page_obj.object_list,
+               'page_obj': page_obj,
+               'hits': paginator.count,
+               'category_types': CategoryType.objects.all()}
+    return render_to_response('booklistapp/search.html', context,
+                              context_instance=RequestContext(request))
+
+
+def popular(request):
+    """The most recommended books, most recently recommended first among equals."""
+    books = Book.objects.filter(recommendation_count__gt=0) \
+                        .order_by('-recommendation_count', '-last_recommended_at', '-id')
+    paginator = Paginator(books, 10)
+    try:
+        page_obj = paginator.page(int(request.GET.get('page', 1)))
+    except (ValueError, InvalidPage):
+        raise Http404
+    context = {'book_list': page_obj.object_list,
+               'page_obj': page_obj,
+               'hits': paginator.count}
+    return render_to_response('booklistapp/popular.html', context,
+                              context_instance=RequestContext(request))
+
+
+def feed(request, category=None):
+    """Atom feed of the most recently edited books, in a category or all."""
+    return _versioned_response(request, 'feed', (category or '',),
+                               lambda version: _render_feed(request, category, version),
+                               mimetype=export.CONTENT_TYPES['atom'])
+
+
+def _render_feed(request, category, version):
+    if category:
+        category_s = get_object_or_404(Category, slug=category)
+        books = category_s.books.all()
+        title = u'%s, Informatics Book List' % category_s.name
+        link = request.build_absolute_uri('/%s/' % category)
+    else:
+        books = Book.objects.all()
+        title = u'Informatics Book List'
+        link = request.build_absolute_uri('/')
+    books = list(books.order_by('-edited', '-id')[:FEED_SIZE])
+    return ''.join(export.atom_feed(export.records(books), title, link, version.changed))
+
+
+def export_books(request, format):
+    """The whole catalogue, streamed; see export.py."""
+    response = HttpResponse(export.export(format, link=request.build_absolute_uri('/')),
+                            mimetype=export.CONTENT_TYPES[format])
+    if format != 'atom':
+        response['Content-Disposition'] = 'attachment; filename=booklist.%s' % format
+    return response
+
+
 def feedback(request):
     if 'text' in request.POST:
         f = FeedbackNote(text=request.POST['text'])
@@ -0,0 +1,218 @@
+"""
+Shared keep-alive HTTP client.
+
+Every outbound request the booklist makes (Google Books in gbooks,
+Amazon in ecs, UCI WebAuth in uciwebauth) goes through the one
+ConnectionPool here, so repeated calls to the same host reuse an
+open TCP/TLS connection instead of handshaking each time.
+
+    response = httpclient.urlopen('http://example.com/feed')
+    data = response.read()
+
+Responses are read completely before being returned, which lets the
+connection go straight back to the pool; they are file-like enough
+to hand to a parser. The pool is thread-safe, caps the number of
+connections open to each host, and applies separate connect and
+read timeouts.
+"""
+import errno
+import httplib
+import socket
+import threading
+import urlparse
+from StringIO import StringIO
+
+CONNECT_TIMEOUT = 10    # Seconds to establish a connection.
+READ_TIMEOUT = 30       # Seconds to wait on each read from a connection.
+MAX_PER_HOST = 4        # Simultaneous connections to any one host.
+MAX_REDIRECTS = 5
+
+# Methods that are safe to send twice, so a request that fails on a
+# stale pooled connection can be retried on another.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+
+class HTTPError(IOError):
+    """Raised by urlopen() for 4xx and 5xx responses."""
+    def __init__(self, url, status, reason, response):
+        IOError.__init__(self, "HTTP Error %d: %s (%s)" % (status, reason, url))
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.response = response
+
+
+class Response(object):
+    """A completely read HTTP response."""
+    def __init__(self, url, status, reason, msg, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+        self.body = body
+        self._fp = StringIO(body)
+
+    def read(self, size=-1):
+        return self._fp.read(size)
+
+    def info(self):
+        return self.msg
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def close(self):
+        pass
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of keep-alive connections, keyed by host."""
+
+    def __init__(self, max_per_host=MAX_PER_HOST,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._idle = {}     # (scheme, host, port) -> [connection, ...]
+        self._slots = {}    # (scheme, host, port) -> semaphore
+        self._stats = {'requests': 0, 'connections': 0, 'reused': 0,
+                       'errors': 0}
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """
+        Send a request and return its Response, following redirects
+        the way urllib2 does. Error statuses are returned, not raised.
+        """
+        for i in range(MAX_REDIRECTS + 1):
+            response = self._request_once(method, url, body, headers or {},
+                                          timeout)
+            location = response.getheader('location')
+            if response.status not in (301, 302, 303, 307) or not location:
+                return response
+            url = urlparse.urljoin(url, location)
+            if response.status != 307:
+                method, body = 'GET', None
+        return response
+
+    def stats(self):
+        """Return a dict of request and connection counts."""
+        with self._lock:
+            s = dict(self._stats)
+            s['idle'] = sum(len(conns) for conns in self._idle.values())
+            s['hosts'] = len(self._slots)
+        return s
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _request_once(self, method, url, body, headers, timeout):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        key = (scheme, netloc)
+        path = (path or '/') + (query and '?' + query or '')
+        slot = self._slot(key)
+        slot.acquire()
+        try:
+            with self._lock:
+                self._stats['requests'] += 1
+            while True:
+                conn, reused = self._checkout(key, timeout)
+                r = None
+                try:
+                    conn.request(method, path, body, headers)
+                    r = conn.getresponse()
+                    data = r.read()
+                except (socket.error, httplib.HTTPException), e:
+                    conn.close()
+                    # A pooled connection the server has since closed
+                    # fails before any response; try the next one, or
+                    # a fresh one, if the request can safely be resent.
+                    if reused and r is None and _is_stale(e) and \
+                       method in IDEMPOTENT_METHODS:
+                        continue
+                    with self._lock:
+                        self._stats['errors'] += 1
+                    raise
+                break
+            if r.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.setdefault(key, []).append(conn)
+            return Response(url, r.status, r.reason, r.msg, data)
+        finally:
+            slot.release()
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[key]
+
+    def _checkout(self, key, timeout):
+        """Return (connection, reused) for key, connecting if none is idle."""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self._stats['reused'] += 1
+                conn = idle.pop()
+                conn.sock.settimeout(timeout or self.read_timeout)
+                return conn, True
+            self._stats['connections'] += 1
+        scheme, netloc = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(timeout or self.read_timeout)
+        return conn, False
+
+
+def _is_stale(error):
+    """
+    Return whether error is how a request on a connection the server
+    has closed fails: never a timeout, which a slow server causes too.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return isinstance(error, socket.error) and \
+           error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
+pool = ConnectionPool()
+
+
+def request(method, url, body=None, headers=None, timeout=None):
+    """Send a request through the shared pool and return its Response."""
+    return pool.request(method, url, body, headers, timeout)
+
+
+def urlopen(url, data=None, headers=None, timeout=None):
+    """
+    Like urllib2.urlopen, through the shared pool: POSTs data if given,
+    and raises HTTPError for 4xx and 5xx responses.
+    """
+    headers = dict(headers or {})
+    if data is not None:
+        headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+    response = pool.request(data is None and 'GET' or 'POST', url, data,
+                            headers, timeout)
+    if response.status >= 400:
+        raise HTTPError(url, response.status, response.reason, response)
+    return response
+
+
+def stats():
+    """Return the shared pool's statistics."""
+    return pool.stats()
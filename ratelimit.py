@@ -0,0 +1,155 @@
+"""
+Client-side rate limiting and retries for outbound requests.
+
+A RateLimiter keeps a token bucket for each key it is given (an
+upstream host, or a host and account), refilled at `rate` tokens a
+second up to `burst`. Each request takes a token, first sleeping until
+one is due if the bucket is empty. Tokens are handed out in order, so
+a queue of callers is spread out at the rate rather than retrying in
+a herd.
+
+    limiter = RateLimiter(rate=1)
+    response = limiter.call('webservices.amazon.com', fetch, is_transient)
+
+The buckets are in memory, shared by the threads of one process,
+unless a path is given: then they are rows in an SQLite file that
+every process uses, for limits that apply to an account rather than
+to one process.
+
+call() also retries, after a jittered exponential backoff, a request
+failing with an error is_transient() accepts (throttling, 5xx), and
+counts how long requests spend queued; see stats().
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+
+RETRY_ATTEMPTS = 4      # Tries in all, before the error is raised.
+RETRY_BASE = 1.0        # Seconds before the first retry.
+RETRY_CAP = 30.0        # Most seconds between retries.
+
+
+def backoff(retries, base=RETRY_BASE, cap=RETRY_CAP):
+    """
+    Return how long to wait before retry number `retries` (from 0):
+    doubling each time, up to cap, and jittered so that callers which
+    failed together don't all retry together.
+    """
+    return min(cap, base * 2 ** retries) * random.uniform(0.5, 1.0)
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate, burst=1, path=None, timeout=30):
+        self.rate = float(rate)
+        self.burst = burst
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._buckets = {}  # key -> (tokens, time)
+        self._stats = {}    # key -> {'requests': ..., ...}
+
+    def wait(self, key):
+        """
+        Take a token from key's bucket, sleeping until it is due.
+        Returns the number of seconds slept.
+        """
+        delay = self._reserve(key)
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            s = self._stats.setdefault(key, {'requests': 0, 'queued': 0,
+                                             'queued_time': 0.0,
+                                             'max_queued_time': 0.0,
+                                             'retries': 0})
+            s['requests'] += 1
+            if delay > 0:
+                s['queued'] += 1
+                s['queued_time'] += delay
+                s['max_queued_time'] = max(s['max_queued_time'], delay)
+        return delay
+
+    def call(self, key, func, is_transient=None, attempts=RETRY_ATTEMPTS):
+        """
+        Return func(), called once a token for key is due. If it raises
+        an exception is_transient(exception) is true of, it is called
+        again after backoff(), up to `attempts` times in all.
+        """
+        for n in range(attempts):
+            self.wait(key)
+            try:
+                return func()
+            except Exception, e:
+                if n + 1 >= attempts or not (is_transient and is_transient(e)):
+                    raise
+            with self._lock:
+                self._stats[key]['retries'] += 1
+            time.sleep(backoff(n))
+
+    def stats(self):
+        """
+        Return {key: counts} of requests, how many of them were queued,
+        the total and longest time queued in seconds, and retries.
+        """
+        with self._lock:
+            return dict((key, dict(s)) for key, s in self._stats.items())
+
+    def _take(self, tokens, updated, now):
+        """
+        Refill a bucket to now and take a token; return (tokens, time,
+        delay). The bucket's time never goes backwards, which would
+        refill it twice over the same interval.
+        """
+        tokens = min(self.burst, tokens + max(0, now - updated) * self.rate) - 1
+        updated = max(updated, now)
+        return tokens, updated, max(0.0, updated - now - tokens / self.rate)
+
+    def _reserve(self, key):
+        """Take a token from key's bucket; return how long until it is due."""
+        if self.path:
+            try:
+                return self._reserve_shared(key)
+            except sqlite3.Error:
+                pass    # Limit this process on its own, rather than fail.
+        with self._lock:
+            now = time.time()
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens, updated, delay = self._take(tokens, updated, now)
+            self._buckets[key] = (tokens, updated)
+        return delay
+
+    def _reserve_shared(self, key):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    pass    # connect() will fail with an sqlite3.Error
+            db = sqlite3.connect(self.path, timeout=self.timeout,
+                                 isolation_level=None)
+            db.execute('CREATE TABLE IF NOT EXISTS bucket ('
+                       ' key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self._local.db = db
+        # IMMEDIATE takes the write lock up front, so no other process
+        # can read the bucket between our read and write.
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Read the clock only once we hold the lock, which may have
+            # taken up to timeout seconds to get.
+            now = time.time()
+            row = db.execute('SELECT tokens, updated FROM bucket WHERE key = ?',
+                             (key,)).fetchone()
+            tokens, updated = row or (self.burst, now)
+            tokens, updated, delay = self._take(tokens, updated, now)
+            db.execute('INSERT OR REPLACE INTO bucket VALUES (?, ?, ?)',
+                       (key, tokens, updated))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        return delay
@@ -80,6 +80,33 @@ INSTALLED_APPS = (
 
 LOGIN_URL = "/login/"
 
+# Rendered list pages are cached here; see views.index.
+CACHE_BACKEND = 'locmem://'
+PAGE_CACHE_TIMEOUT = 60 * 60
+
+# Full-text index for /search/: 'fts5' (SQLite only), 'terms' (any
+# database), or 'auto' to use FTS5 where available. See search.py.
+SEARCH_BACKEND = 'auto'
+
+# Book covers are downloaded into COVER_DIR by the fetch_covers
+# management command, which works through the CoverFetch queue.
+COVER_DIR = '/opt/infxbooklist/bookcovers'
+COVER_FETCH_TIMEOUT = 10        # Seconds to wait on a cover host.
+COVER_FETCH_CONCURRENCY = 4     # Simultaneous downloads per worker.
+COVER_FETCH_MAX_ATTEMPTS = 6    # Give up on a cover after this many.
+
+# Amazon ECS responses are cached in this SQLite file, which every
+# process shares; None turns the cache off. See ecs.CACHE_TTLS.
+ECS_CACHE_PATH = '/opt/infxbooklist/cache/ecs.sqlite'
+ECS_CACHE_MAX_SIZE = 50 * 2**20     # Bytes, compressed.
+
+# Outbound requests are rate limited per host (and per key, for
+# Amazon), with the buckets in this SQLite file so that every process
+# shares them; None limits each process on its own. See ratelimit.py.
+RATE_LIMIT_PATH = '/opt/infxbooklist/cache/ratelimit.sqlite'
+ECS_RATE_LIMIT = 1          # Requests a second per license key.
+GBOOKS_RATE_LIMIT = 5       # Requests a second.
+
 # If there is a local_settings module,
 # it should be allowed to override the
 # above. This is for clean deployment.
@@ -0,0 +1,135 @@
+"""
+Tests of httpclient against a local stand-in server.
+
+    python -m unittest test_httpclient
+"""
+import BaseHTTPServer
+import SocketServer
+import socket
+import threading
+import time
+import unittest
+import httpclient
+
+
+class StandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A keep-alive HTTP server counting the connections and requests it gets."""
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+
+    def handle_error(self, request, client_address):
+        pass    # Clients that time out leave broken pipes behind.
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self._respond()
+
+    def _respond(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+        if self.path == '/slow':
+            time.sleep(1)
+        body = 'hello'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/drop':
+            # Close without saying so, as a server timing out an idle
+            # keep-alive connection does.
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandIn()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.pool = httpclient.ConnectionPool(max_per_host=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def urlopen(self, path, data=None, timeout=None):
+        return self.pool.request(data is None and 'GET' or 'POST',
+                                 self.server.url(path), data, {}, timeout)
+
+    def test_reuses_connection(self):
+        for i in range(10):
+            self.assertEqual(self.urlopen('/').read(), 'hello')
+        self.assertEqual(self.server.connections, 1)
+        stats = self.pool.stats()
+        self.assertEqual(stats['requests'], 10)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['reused'], 9)
+
+    def test_caps_connections_per_host(self):
+        threads = [threading.Thread(target=self.urlopen, args=('/slow',))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertTrue(self.server.connections <= 2)
+
+    def test_retries_get_on_stale_connection(self):
+        self.urlopen('/drop')
+        time.sleep(0.1)
+        self.assertEqual(self.urlopen('/').read(), 'hello')
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.server.requests, [('GET', '/drop'), ('GET', '/')])
+
+    def test_does_not_resend_post_on_stale_connection(self):
+        self.urlopen('/drop')
+        time.sleep(0.1)
+        self.assertRaises((socket.error, httpclient.httplib.HTTPException),
+                          self.urlopen, '/', 'data')
+        self.assertEqual(self.server.requests, [('GET', '/drop')])
+
+    def test_does_not_resend_on_timeout(self):
+        # Leave two idle connections, either of which could be retried on.
+        threads = [threading.Thread(target=self.urlopen, args=('/slow',))
+                   for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        del self.server.requests[:]
+        started = time.time()
+        self.assertRaises(socket.timeout, self.urlopen, '/slow', 'data', 0.5)
+        self.assertTrue(time.time() - started < 0.9)
+        self.assertRaises(socket.timeout, self.urlopen, '/slow', None, 0.5)
+        time.sleep(1)
+        self.assertEqual(self.server.requests, [('POST', '/slow'), ('GET', '/slow')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+"""
+Tests of uciwebauth against local stand-ins for WebAuth and LDAP.
+
+    python -m unittest test_uciwebauth
+"""
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import unittest
+import uciwebauth
+from uciwebauth import LdapPerson, LdapPersonError, WebAuth, WebAuthError
+
+TOKEN = 'a' * 64
+
+PERSON = ('uid=tester,ou=people', {
+    'objectClass': ['eduPerson'], 'campusId': ['000012345678'],
+    'ucinetid': ['tester'], 'givenName': ['TESTY'], 'sn': ['TESTER'],
+    'mail': ['tester@uci.edu'], 'cn': ['Testy Tester']})
+
+
+class WebAuthStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local webauth_check, counting the checks it answers. TOKEN is a
+    valid token, with the attributes in `attrs`; any other isn't.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), WebAuthHandler)
+        self.checks = 0
+        self.delay = 0
+        self.attrs = {'ucinetid': 'tester', 'campus_id': '000012345678',
+                      'auth_host': '127.0.0.1', 'age_in_seconds': 10,
+                      'seconds_since_checked': 5, 'login_timeout': 3600,
+                      'max_idle_time': 1200}
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        pass    # Clients that time out leave broken pipes behind.
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+
+class WebAuthHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self.server.checks += 1
+        time.sleep(self.server.delay)
+        if data == 'ucinetid_auth=' + TOKEN:
+            body = '\n'.join('%s=%s' % item for item in self.server.attrs.items())
+        else:
+            body = 'auth_fail=No such token\nerror_code=NOT_FOUND'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class WebAuthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = WebAuthStandIn()
+        self._check_url = WebAuth.CHECK_URL
+        WebAuth.CHECK_URL = self.server.url('/ucinetid/webauth_check')
+        WebAuth._check_cache.clear()
+
+    def tearDown(self):
+        WebAuth.CHECK_URL = self._check_url
+        WebAuth._check_cache.clear()
+        if uciwebauth.httpclient is not None:
+            uciwebauth.httpclient.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_checks_are_cached(self):
+        for n in range(5):
+            auth = WebAuth(TOKEN)
+            self.assertEqual(auth.ucinetid, 'tester')
+        self.assertEqual(self.server.checks, 1)
+        auth.check(cached=False)
+        self.assertEqual(self.server.checks, 2)
+
+    def test_cache_can_be_turned_off(self):
+        for n in range(3):
+            WebAuth(TOKEN, cache_ttl=0)
+        self.assertEqual(self.server.checks, 3)
+
+    def test_failed_checks_are_not_cached(self):
+        for n in range(2):
+            self.assertRaises(WebAuthError, WebAuth, 'b' * 64)
+        self.assertEqual(self.server.checks, 2)
+
+    def test_cached_check_advances_age(self):
+        WebAuth(TOKEN)
+        checked, attrs = WebAuth._check_cache[TOKEN]
+        WebAuth._check_cache[TOKEN] = (checked - 30, attrs)
+        auth = WebAuth(TOKEN)
+        self.assertEqual(self.server.checks, 1)
+        self.assertEqual(auth.age_in_seconds, 40)
+        self.assertEqual(auth.seconds_since_checked, 35)
+
+    def test_cached_check_expires_at_login_timeout(self):
+        self.server.attrs['age_in_seconds'] = 3590
+        WebAuth(TOKEN)
+        checked, attrs = WebAuth._check_cache[TOKEN]
+        WebAuth._check_cache[TOKEN] = (checked - 20, attrs)
+        WebAuth(TOKEN)
+        self.assertEqual(self.server.checks, 2)
+
+    def test_cached_check_expires_at_max_idle_time(self):
+        self.server.attrs['seconds_since_checked'] = 1190
+        WebAuth(TOKEN)
+        checked, attrs = WebAuth._check_cache[TOKEN]
+        WebAuth._check_cache[TOKEN] = (checked - 20, attrs)
+        WebAuth(TOKEN)
+        self.assertEqual(self.server.checks, 2)
+
+    def test_timeout(self):
+        self.server.delay = 2
+        started = time.time()
+        self.assertRaises(WebAuthError, WebAuth, TOKEN, timeout=0.5)
+        self.assertTrue(time.time() - started < 1.5)
+        self.assertEqual(self.server.checks, 1)
+
+
+class FakeDirectory(object):
+    """
+    Stands in for ldap.initialize(): hands out connections to a
+    directory holding PERSON, counting connections and searches.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.searches = 0
+        self.open = 0
+        self.most_open = 0
+        self.delay = 0
+        self.fail_next = 0     # Searches to fail with SERVER_DOWN.
+
+    def __call__(self, uri):
+        with self.lock:
+            self.connections += 1
+        return FakeConnection(self)
+
+
+class FakeConnection(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.results = {}
+
+    def set_option(self, option, value):
+        pass
+
+    def search(self, base, scope, filter, attrlist=None):
+        d = self.directory
+        with d.lock:
+            d.searches += 1
+            if d.fail_next:
+                d.fail_next -= 1
+                raise uciwebauth.ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+            d.open += 1
+            d.most_open = max(d.most_open, d.open)
+        time.sleep(d.delay)
+        with d.lock:
+            d.open -= 1
+        attr, value = filter.split('=', 1)
+        values = dict((k.lower(), v) for k, v in PERSON[1].items()).get(attr.lower(), [])
+        found = value.strip('*').lower() in [v.lower() for v in values]
+        id = len(self.results) + 1
+        self.results[id] = found and [PERSON, (None, ['ldap://elsewhere'])] or []
+        return id
+
+    def result(self, id, all=1, timeout=None):
+        return 101, self.results.pop(id)
+
+    def unbind_s(self):
+        pass
+
+
+class LdapPersonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = FakeDirectory()
+        self._initialize = uciwebauth.ldap.initialize
+        uciwebauth.ldap.initialize = self.directory
+        LdapPerson._pool = None
+        LdapPerson._cache.clear()
+
+    def tearDown(self):
+        uciwebauth.ldap.initialize = self._initialize
+        LdapPerson._pool = None
+        LdapPerson._cache.clear()
+
+    def test_finds_person(self):
+        p = LdapPerson('tester')
+        self.assertEqual(p.campusId, '000012345678')
+        self.assertEqual(p.mail, 'tester@uci.edu')
+        self.assertEqual(p.pretty_name, 'Testy Tester')
+        self.assertRaises(LdapPersonError, LdapPerson, 'nobody')
+
+    def test_records_are_cached_by_campus_id_and_ucinetid(self):
+        LdapPerson(12345678)
+        LdapPerson('000012345678')
+        LdapPerson('TESTER')
+        self.assertEqual(self.directory.searches, 1)
+
+    def test_rdn_searches_are_not_cached(self):
+        LdapPerson('Testy Tester', 'cn')
+        LdapPerson('Testy Tester', 'cn')
+        self.assertEqual(self.directory.searches, 2)
+
+    def test_connection_is_reused(self):
+        for n in range(3):
+            LdapPerson('Testy Tester', 'cn')
+        self.assertEqual(self.directory.connections, 1)
+
+    def test_reconnects_once_when_server_went_away(self):
+        LdapPerson('Testy Tester', 'cn')
+        self.directory.fail_next = 1
+        LdapPerson('Testy Tester', 'cn')
+        self.assertEqual(self.directory.connections, 2)
+        self.directory.fail_next = 2
+        self.assertRaises(LdapPersonError, LdapPerson, 'Testy Tester', 'cn')
+
+    def test_pool_caps_connections(self):
+        self.directory.delay = 0.2
+        threads = [threading.Thread(target=LdapPerson, args=('Testy Tester', 'cn'))
+                   for n in range(LdapPerson.POOL_SIZE * 2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.directory.searches, LdapPerson.POOL_SIZE * 2)
+        self.assertTrue(self.directory.connections <= LdapPerson.POOL_SIZE)
+        self.assertTrue(self.directory.most_open <= LdapPerson.POOL_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
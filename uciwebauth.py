@@ -58,17 +58,27 @@ from __future__ import division, print_function
 import sys
 import os
 import re
+import threading
+import time
 
 if sys.version[0] == '2':
     from urllib import urlencode
     from urllib2 import Request, urlopen
     from urlparse import urlunsplit
+    from Queue import Queue
 else:
     from urllib.parse import urlencode, urlunsplit
     from urllib.request import Request, urlopen
+    from queue import Queue
 
 import ldap
 
+try:
+    # Keep-alive connections shared with the rest of the application.
+    import httpclient
+except ImportError:
+    httpclient = None
+
 try:
     from django.conf import settings
     from django.contrib.auth.models import User, check_password
@@ -124,6 +134,14 @@ class WebAuth(object):
     error_code : str or None
         Key to ERROR_CODES.
 
+    Successful checks are cached per token for CHECK_CACHE_TTL seconds,
+    so a token checked again soon after costs no round trip to
+    webauth_check; age_in_seconds and seconds_since_checked are
+    advanced by the time since, and a cached check is not used once
+    they pass login_timeout or max_idle_time. TIMEOUT is the network
+    timeout for requests to WebAuth. Both can be overridden per
+    instance.
+
     Examples
     --------
 
@@ -170,7 +188,20 @@ class WebAuth(object):
         'campus_id': str, 'uci_affiliations': str, 'age_in_seconds': int,
         'seconds_since_checked': int, 'auth_fail': str, 'error_code': str}
 
-    def __init__(self, usrid=None, password=None):
+    TIMEOUT = 10
+    CHECK_CACHE_TTL = 60
+    CHECK_CACHE_SIZE = 10000
+
+    # ucinetid_auth -> (time checked, dict of ATTRS values)
+    _check_cache = {}
+    _check_cache_lock = threading.Lock()
+
+    def __init__(self, usrid=None, password=None, timeout=None,
+                 cache_ttl=None):
+        if timeout is not None:
+            self.TIMEOUT = timeout
+        if cache_ttl is not None:
+            self.CHECK_CACHE_TTL = cache_ttl
         if usrid:
             self.authenticate(usrid, password)
         else:
@@ -194,18 +225,22 @@ class WebAuth(object):
             raise WebAuthError('No valid ucinetid_auth token found')
         self.check()
 
-    def check(self):
+    def check(self, cached=True):
         """Get data associated with ucinetid_auth token.
 
+        A recent successful check of the same token is reused unless
+        cached is False.
+
         Raise WebAuthError on failure.
 
         """
         if not self.ucinetid_auth:
             return
+        if cached and self._check_cached():
+            return
         data = urlencode({'ucinetid_auth': self.ucinetid_auth})
-        request = Request(self.CHECK_URL, data, self.USER_AGENT)
         try:
-            response = urlopen(request).read()
+            response = self._post(self.CHECK_URL, data).read()
         except Exception:
             raise WebAuthError("UCI webauth_check site not found")
         for line in response.splitlines():
@@ -216,15 +251,17 @@ class WebAuth(object):
                 pass
         if self.auth_fail:
             raise WebAuthError(self.auth_fail)
+        self._cache_check()
 
     def logout(self):
         """Clear ucinetid_auth entry in UCI WebAuth database."""
         if not self.ucinetid_auth:
             return
+        with self._check_cache_lock:
+            self._check_cache.pop(self.ucinetid_auth, None)
         data = urlencode({'ucinetid_auth': self.ucinetid_auth})
-        request = Request(self.LOGOUT_URL, data, self.USER_AGENT)
         try:
-            response = urlopen(request).read()
+            response = self._post(self.LOGOUT_URL, data).read()
         except Exception:
             raise WebAuthError("UCI webauth_logout site not found")
         self._clear()
@@ -247,6 +284,58 @@ class WebAuth(object):
         return self.LOGOUT_URL + '?' + urlencode(
             {'ucinetid_auth': self.ucinetid_auth, 'return_url': return_url})
 
+    def _post(self, url, data):
+        """POST data to url and return the response."""
+        if httpclient is not None:
+            return httpclient.urlopen(url, data, self.USER_AGENT,
+                                      timeout=self.TIMEOUT)
+        return urlopen(Request(url, data, self.USER_AGENT),
+                       timeout=self.TIMEOUT)
+
+    def _check_cached(self):
+        """Set attributes from a cached check; return whether there was one."""
+        if not self.CHECK_CACHE_TTL:
+            return False
+        with self._check_cache_lock:
+            entry = self._check_cache.get(self.ucinetid_auth)
+        if entry is None:
+            return False
+        elapsed = int(time.time() - entry[0])
+        if elapsed >= self.CHECK_CACHE_TTL or elapsed < 0:
+            return False
+        # WebAuth would by now reject a token past its login timeout or
+        # idle for longer than it may be.
+        for attr, limit in (('age_in_seconds', 'login_timeout'),
+                            ('seconds_since_checked', 'max_idle_time')):
+            value, limit = entry[1].get(attr), entry[1].get(limit)
+            if value is not None and limit and value + elapsed > limit:
+                with self._check_cache_lock:
+                    self._check_cache.pop(self.ucinetid_auth, None)
+                return False
+        for attr, value in entry[1].items():
+            setattr(self, attr, value)
+        for attr in ('age_in_seconds', 'seconds_since_checked'):
+            value = getattr(self, attr)
+            if value is not None:
+                setattr(self, attr, value + elapsed)
+        return True
+
+    def _cache_check(self):
+        """Cache the attributes set by a successful check."""
+        if not self.CHECK_CACHE_TTL:
+            return
+        now = time.time()
+        attrs = dict((attr, getattr(self, attr)) for attr in self.ATTRS)
+        with self._check_cache_lock:
+            cache = self._check_cache
+            if len(cache) >= self.CHECK_CACHE_SIZE:
+                for token, entry in list(cache.items()):
+                    if now - entry[0] >= self.CHECK_CACHE_TTL:
+                        del cache[token]
+                if len(cache) >= self.CHECK_CACHE_SIZE:
+                    cache.clear()
+            cache[self.ucinetid_auth] = (now, attrs)
+
     def _clear(self):
         """Initialize attributes to None."""
         self.ucinetid_auth = None
@@ -272,9 +361,8 @@ class WebAuth(object):
             'ucinetid': ucinetid, 'password': password,
             'return_url': '', 'referer': '', 'info_text': '',
             'info_url': '', 'submit_type': '', 'login_button': 'Login'})
-        request = Request(self.LOGIN_URL, data, self.USER_AGENT)
         try:
-            response = urlopen(request)
+            response = self._post(self.LOGIN_URL, data)
         except Exception:
             raise WebAuthError("UCI webauth site not found")
 
@@ -315,6 +403,10 @@ class LdapPerson(object):
     as an attribute.
     The complete LDAP search results are stored as 'records'.
 
+    Searches share a pool of connections to SERVER (see LdapPool), and
+    the records found by campusId or ucinetid are cached for CACHE_TTL
+    seconds under both.
+
     Examples
     --------
 
@@ -336,9 +428,18 @@ class LdapPerson(object):
     ATTRS = ('cn', 'uid', 'campusId', 'ucinetid', 'UCIaffiliation',
              'lastFirstName', 'givenName', 'sn', 'mail', 'telephoneNumber',
              'homePageUrl', 'department', 'postalAddress', 'postalCode',
-             'mailcode', 'type', 'AlumniDate', 'AlumniEmail'
+             'mailcode', 'type', 'AlumniDate', 'AlumniEmail',
              'major', 'studentLevel', 'displayName', 'rewrite',
              'mailDeliveryPoint', 'objectClass', 'pretty_name')
+    TIMEOUT = 10
+    POOL_SIZE = 4
+    CACHE_TTL = 600
+    CACHE_SIZE = 10000
+
+    _pool = None
+    # search filter -> (time found, DN, records)
+    _cache = {}
+    _lock = threading.Lock()
 
     def __init__(self, value=None, rdn=None, types=TYPES):
         if value:
@@ -364,27 +465,21 @@ class LdapPerson(object):
             except Exception:
                 filter = "ucinetid=%s" % str(value)
 
-        try:
-            l = ldap.open(self.SERVER)
-        except ldap.LDAPError as e:
-            raise LdapPersonError(e)
-
-        try:
-            id = l.search(self.BASEDN, ldap.SCOPE_SUBTREE, filter, None)
-            results = []
-            while 1:
-                type, data = l.result(id, 0)
-                if not data:
-                    break
-                elif type == ldap.RES_SEARCH_ENTRY:
-                    results.append(data)
-        except ldap.LDAPError as e:
-            raise LdapPersonError(e)
-
-        if len(results) != 1:
-            raise LdapPersonError("%s not found or result ambiguous." % filter)
-
-        self.DN, self.records = results[0][0]
+        found = self._cached(filter.lower())
+        if found is None:
+            try:
+                results = self.pool().search(self.BASEDN, ldap.SCOPE_SUBTREE,
+                                             filter, list(self.ATTRS))
+            except ldap.LDAPError as e:
+                raise LdapPersonError(e)
+            if len(results) != 1:
+                raise LdapPersonError(
+                    "%s not found or result ambiguous." % filter)
+            found = results[0]
+            if not rdn:
+                self._cache_records(found)
+
+        self.DN, self.records = found
 
         if not self._is_type(types):
             raise LdapPersonError("%s has wrong type." % filter)
@@ -400,6 +495,46 @@ class LdapPerson(object):
         except Exception:
             self.pretty_name = None
 
+    @classmethod
+    def pool(cls):
+        """Return the connection pool to SERVER, creating it on first use."""
+        with cls._lock:
+            if cls._pool is None:
+                cls._pool = LdapPool(cls.SERVER, cls.POOL_SIZE, cls.TIMEOUT)
+            return cls._pool
+
+    def _cached(self, filter):
+        """Return cached (DN, records) found by lower-cased filter, or None."""
+        with self._lock:
+            entry = self._cache.get(filter)
+        if entry is not None and time.time() - entry[0] < self.CACHE_TTL:
+            return entry[1:]
+
+    def _cache_records(self, found):
+        """Cache (DN, records) under the campusId and ucinetid filters."""
+        if not self.CACHE_TTL:
+            return
+        now = time.time()
+        records = found[1]
+        keys = []
+        for value in records.get('campusId', ()):
+            try:
+                keys.append("campusid=%.12i" % int(value))
+            except ValueError:
+                pass
+        for value in records.get('ucinetid', ()):
+            keys.append("ucinetid=%s" % value.lower())
+        with self._lock:
+            cache = self._cache
+            if len(cache) + len(keys) > self.CACHE_SIZE:
+                for key, entry in list(cache.items()):
+                    if now - entry[0] >= self.CACHE_TTL:
+                        del cache[key]
+                if len(cache) + len(keys) > self.CACHE_SIZE:
+                    cache.clear()
+            for key in keys:
+                cache[key] = (now,) + tuple(found)
+
     def _is_type(self, types=TYPES):
         """Return whether record is one of types."""
         if not types:
@@ -429,47 +564,119 @@ class LdapPersonError(Exception):
     pass
 
 
+class LdapPool(object):
+    """Thread-safe pool of connections to an LDAP server.
+
+    At most `size` connections are open at once; a search waits for a
+    free one. A connection that fails with SERVER_DOWN or CONNECT_ERROR
+    is dropped and the search retried once on a new one, so a server
+    restart or idle disconnect costs one reconnect, not an error.
+
+    """
+
+    def __init__(self, server, size=4, timeout=10):
+        self.server = server
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def search(self, base, scope, filter, attrlist=None):
+        """Return all (dn, entry) results of a search, in one round trip."""
+        self._slots.acquire()
+        try:
+            for retry in (True, False):
+                conn = self._checkout()
+                try:
+                    id = conn.search(base, scope, filter, attrlist)
+                    type, data = conn.result(id, 1, self.timeout)
+                except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+                    self._discard(conn)
+                    if retry:
+                        continue
+                    raise
+                except ldap.LDAPError:
+                    self._discard(conn)
+                    raise
+                with self._lock:
+                    self._idle.append(conn)
+                # Search references come back with a dn of None.
+                return [(dn, entry) for dn, entry in data if dn is not None]
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Unbind every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        conn = ldap.initialize('ldap://%s' % self.server)
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        conn.set_option(ldap.OPT_REFERRALS, 0)
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
 class DjangoBackend:
     """Django authentication backend using UCI WebAuth service.
 
     Add 'path.to.uciwebauth.DjangoBackend' to AUTHENTICATION_BACKENDS
     in the Django project settings.py file.
 
+    New users are created straight away with default names and email;
+    their LDAP record is looked up afterwards by a background thread
+    (see enrich_user), so a slow directory doesn't hold up the login.
+    The user's empty name records that the lookup is still to be done,
+    so a user whose lookup was lost is queued again at their next login.
+
     """
 
+    # Lower-cased settings.ADMIN_UCINETIDS, computed on first use.
+    admins = None
+
     def authenticate(self, username=None, password=None):
         try:
-            webauth_user = WebAuth(username, password)
+            webauth_user = WebAuth(
+                username, password,
+                timeout=getattr(settings, 'WEBAUTH_TIMEOUT', None),
+                cache_ttl=getattr(settings, 'WEBAUTH_CACHE_TTL', None))
         except WebAuthError:
             return None
 
         if webauth_user.ucinetid:
+            is_admin = self.is_admin(webauth_user.ucinetid)
             try:
                 user = User.objects.get(username=username)
             except User.DoesNotExist:
                 # Create a new Django user.
                 user = User(username=username, password="")
                 user.set_unusable_password()
-                try:
-                    ldap_user = LdapPerson(webauth_user.campus_id)
-                except LdapPersonError:
-                    user.email = username + '@uci.edu'
-                else:
-                    user.first_name = ldap_user.givenName.title()
-                    user.last_name = ldap_user.sn.title()
-                    user.email = ldap_user.mail
-                    if not user.email:
-                        user.email = username + '@uci.edu'
-                user.is_staff = webauth_user.ucinetid.lower() in [x.lower() for x in settings.ADMIN_UCINETIDS]
+                user.email = username + '@uci.edu'
+                user.is_staff = is_admin
                 user.is_superuser = user.is_staff
                 user.save()
+                enrich_user(user.pk, webauth_user.campus_id)
             else:
-                should_be_staff = webauth_user.ucinetid.lower() in [x.lower() for x in settings.ADMIN_UCINETIDS]
-                if user.is_staff != should_be_staff:
+                if user.is_staff != is_admin:
                     # update staff state; write to db
-                    user.is_staff = should_be_staff
-                    user.is_superuser = should_be_staff
+                    user.is_staff = is_admin
+                    user.is_superuser = is_admin
                     user.save()
+                if not (user.first_name or user.last_name):
+                    # Never enriched: the lookup failed, or was still
+                    # queued when the process exited.
+                    enrich_user(user.pk, webauth_user.campus_id)
             return user
 
         return None
@@ -480,6 +687,66 @@ class DjangoBackend:
         except User.DoesNotExist:
             return None
 
+    def is_admin(self, ucinetid):
+        """Return whether ucinetid is in settings.ADMIN_UCINETIDS."""
+        admins = DjangoBackend.admins
+        if admins is None:
+            admins = DjangoBackend.admins = frozenset(
+                x.lower() for x in settings.ADMIN_UCINETIDS)
+        return ucinetid.lower() in admins
+
+
+_enrich_queue = Queue()
+_enrich_pending = set()     # ids of the users in _enrich_queue
+_enrich_worker = None
+_enrich_lock = threading.Lock()
+
+
+def enrich_user(user_id, campus_id):
+    """Queue filling in a Django user's name and email from LDAP.
+
+    The lookup runs in a daemon thread, started on first use, and the
+    user is updated with a single UPDATE. The queue is in memory, so
+    lookups still queued when the process exits are lost; DjangoBackend
+    queues those users again when they next log in.
+
+    """
+    global _enrich_worker
+    with _enrich_lock:
+        if user_id in _enrich_pending:
+            return
+        _enrich_pending.add(user_id)
+        if _enrich_worker is None:
+            _enrich_worker = threading.Thread(target=_enrich_users)
+            _enrich_worker.setDaemon(True)
+            _enrich_worker.start()
+    _enrich_queue.put((user_id, campus_id))
+
+
+def _enrich_users():
+    """Work through the enrich_user queue, forever."""
+    while True:
+        user_id, campus_id = _enrich_queue.get()
+        with _enrich_lock:
+            _enrich_pending.discard(user_id)
+        # Nothing may stop the worker, or later users go unenriched.
+        try:
+            ldap_user = LdapPerson(campus_id)
+        except Exception:
+            continue
+        fields = {}
+        if ldap_user.givenName:
+            fields['first_name'] = ldap_user.givenName.title()
+        if ldap_user.sn:
+            fields['last_name'] = ldap_user.sn.title()
+        if ldap_user.mail:
+            fields['email'] = ldap_user.mail
+        try:
+            if fields:
+                User.objects.filter(pk=user_id).update(**fields)
+        except Exception:
+            pass
+
 
 class CgiBackend(object):
     """WebAuth backend for use in CGI scripts.
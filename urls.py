@@ -8,6 +8,11 @@ urlpatterns = patterns('',
     (r'^admin/', include(admin.site.urls)),
     (r'^feedback/$', 'infxbooklist.booklistapp.views.feedback'),
     (r'^edit/$', 'infxbooklist.booklistapp.views.edit'),
+    (r'^search/$', 'infxbooklist.booklistapp.views.search'),
+    (r'^popular/$', 'infxbooklist.booklistapp.views.popular'),
+    (r'^export\.(?P<format>jsonl|csv|atom)$', 'infxbooklist.booklistapp.views.export_books'),
+    (r'^feed\.atom$', 'infxbooklist.booklistapp.views.feed'),
+    (r'^(?P<category>[-\w]+)/feed\.atom$', 'infxbooklist.booklistapp.views.feed'),
     (r'^login/$', 'django.contrib.auth.views.login', {'template_name': 'login.html'}),
 )
 